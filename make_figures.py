@@ -2,7 +2,7 @@
 Starting point for producing figures.
 Figure production can be triggered in different ways.
 An easy way to experiment is to run this script without arguments after filling the list 'do_figures' below.
-To build all figures, run make_figures 'all'. For other command-line options, see at the end of this script.
+To build all figures, run make_figures 'all'. For other command-line options, run make_figures --help.
 
 All usages of this script require:
  - that the dependencies in requirements.txt are satisfied
@@ -10,133 +10,283 @@ All usages of this script require:
 
  For more information, see README.md
 """
-from sys import exit, argv
-from src.mean_percentiles import mean_percentiles
-from src.cumulative import cumulative
-from src.overview import overview
-from src.embers_table import embers_table, embers_rkr_table
-from src.confidence import confidence
+from sys import exit
+from typing import NamedTuple
+from argparse import ArgumentParser
+from fnmatch import fnmatchcase
 from settings_data_access import datasource
 from os.path import join
+from time import perf_counter
+from traceback import format_exc
+from contextvars import copy_context
+from importlib import import_module
+from concurrent.futures import ProcessPoolExecutor
+import src.helpers as hlp
+import settings_configs
+from src.manifest import Manifest
 
 # Default list of figures to build:
 do_figures = ['7']
 
 
-def make_figures(figures=None, out_path=None):
-    all = False
-    if not figures:
-        figures = do_figures
-    elif figures == 'all':
-        all = True
+# Functions building figures, by name: module containing each function; a module is only imported when a figure
+# requires it, so that only the dependencies of the requested figures are loaded (e.g. no matplotlib for tables)
+FUNCTIONS = {
+    'mean_percentiles': 'src.mean_percentiles',
+    'cumulative': 'src.cumulative',
+    'overview': 'src.overview',
+    'embers_table': 'src.embers_table',
+    'embers_rkr_table': 'src.embers_table',
+    'confidence': 'src.confidence',
+}
+
+
+class Figure(NamedTuple):
+    """
+    A figure (or table) which can be built: the name of the function building it (see FUNCTIONS) and its settings;
+    optional figures (e.g. long to build) are not part of 'all': they are only built when requested by their id
+    """
+    function: str
+    settings_choice: str
+    options: tuple = ()
+    title: str = None
+    optional: bool = False
+
+    def kwargs(self, out_path) -> dict:
+        """
+        Arguments of the function (as for settings_configs.get_settings)
+        """
+        return dict(settings_choice=self.settings_choice, options=list(self.options), title=self.title,
+                    out_path=out_path)
+
+
+# Figures which can be built, by id; out_path is added when building
+FIGURES = {
+    '5ad': Figure(
+        'mean_percentiles', "SRs+AR6_global_regional", options=('mean', 'median', 'ember'),
+        title="Figure 5(a)+(d): Global vs reg. mean & med.(AR6+SRs, excl. high adapt. and RFCs)"),
+    '5ad-bootstrap': Figure(
+        'mean_percentiles', "SRs+AR6_global_regional", options=('mean', 'median', 'bootstrap'),
+        title="Figure 5(a)+(d) with bootstrap confidence intervals (90%)", optional=True),
+    '5b': Figure(
+        'mean_percentiles', "SRs+AR6_global_regional", options=('p10-p90',),
+        title="Figure 5(b): Global vs regional p10 & p90 (AR6+SRs, excluding high adapt. and RFCs)"),
+    '5c': Figure(
+        'cumulative', "SRs+AR6noRFCnoHighAdapt",
+        title="Figure 5(c): Cumulative distribution of\n"
+              "transitions mid-points (AR6+SRs, excl. RFCs & high adapt.)"),
+    '5c-alt': Figure(
+        'cumulative', "SRs+AR6noRFC",
+        title="Figure 5(c) - ALT:Cumulative distribution of\ntransitions mid-points (AR6+SRs, excl. RFCs)"),
+    '5ef': Figure(
+        'mean_percentiles', "SRs+AR6_global_regional", options=('mean', 'median', 'ember', 'wchapter'),
+        title="Figure 5(e)+(f) - Global vs regional + chapter weighting"),
+    '6': Figure(
+        'mean_percentiles', "ecosystems_low-adapt_high-adapt", options=('mean', 'median', 'ember'),
+        title="Figure 6(a)+(b): Ecosystems - others w/o high adapt. - others with high adapt. (AR6+SRs)"),
+    '6c': Figure(
+        'mean_percentiles', "SRs_vs_AR6-ecosystems", options=('mean', 'median'),
+        title="Figure 6(c): Ecosystems: compare SRs to AR6"),
+    '6d': Figure(
+        'mean_percentiles', "SRs_vs_AR6-others-no_high-adapt", options=('mean', 'median'),
+        title="Figure 6(d): Other systems: compare SRs to AR6"),
+    '6c-sup': Figure(
+        'mean_percentiles', "ecosystems_low-adapt_high-adapt_AR6", options=('mean', 'median'),
+        title="Figure 6(sup2): compare SRs to AR6 for human systems\n and ecosystem services, no/mod adaptation"),
+    '7': Figure('overview', "overview_systems", title="Figure 7: Overview - systems"),
+    '7v2': Figure('overview', "overview_RKRs", title="Figure 7v2: Overview - RKRs"),
+    '8': Figure('overview', "overview_regions", title="Figure 8: Overview - regional"),
+    '8-sup': Figure('overview', "overview_reg_3.5", title="Figure 8: Overview - regional - 1.5, 2.5, 3.5°C"),
+    'tab3': Figure('embers_table', "All_included", title="Table 3"),  # Preprint version (Chapters)
+    'tab3v2': Figure('embers_rkr_table', "All_included", title="Table 3 - version 2"),  # Revised version (RKRs)
+    'tab4': Figure('confidence', "SRs+AR6_global_regional", title="Table 4"),
+}
+
+
+def figure_function(name):
+    """
+    :param name: the name of a function building figures (see FUNCTIONS)
+    :return: the function, imported from its module
+    """
+    if name not in FUNCTIONS:
+        raise ValueError(f"Unknown function '{name}'; available functions: {', '.join(FUNCTIONS)}")
+    return getattr(import_module(FUNCTIONS[name]), name)
+
+
+def select_figures(patterns) -> list:
+    """
+    :param patterns: figure ids or glob patterns matching figure ids (e.g. '5*'), or 'all';
+                     optional figures only match their id
+    :return: the ids of the matching figures, in the order of the patterns (and of FIGURES for each pattern)
+    """
+    selected = []
+    for pattern in patterns:
+        if pattern in FIGURES:
+            matches = [pattern]
+        elif pattern == 'all':
+            matches = [fig for fig, figure in FIGURES.items() if not figure.optional]
+        else:
+            matches = [fig for fig, figure in FIGURES.items() if fnmatchcase(fig, pattern) and not figure.optional]
+        if not matches:
+            raise ValueError(f"Unknown figure(s): {pattern}; available figures: {', '.join(FIGURES)}")
+        selected += [fig for fig in matches if fig not in selected]
+    return selected
+
+
+def build_figure(fig, out_path):
+    """
+    Builds one figure, catching errors so that the other figures can still be built.
+    The figure is built in its own context, so that its processing report is only the current report while it is built
+    (see src/report.py).
+    :return: (figure id, time in seconds, None or the error message with its traceback)
+    """
+    start = perf_counter()
+    error = copy_context().run(_build_figure, FIGURES[fig], join(out_path, fig))
+    return fig, perf_counter() - start, error
+
+
+def _build_figure(figure, out_path):
+    try:
+        figure_function(figure.function)(**figure.kwargs(out_path))
+        return None
+    except Exception:
+        return format_exc()
+    finally:
+        # Some figures leave their processing report open: make sure it is complete before the process ends
+        hlp.report.close(total=False)
+        # Figures which were not closed (e.g. after an error) would otherwise stay in memory until the end of the run
+        hlp.close_figures()
+
+
+def _init_worker(jobs):
+    # Figures are only saved to files in the worker processes: no windows, no waiting for plt.show()
+    hlp.set_render_mode('headless')
+    # Processes started by a figure (e.g. bootstrap) share the CPUs with the other figures
+    hlp.figure_jobs = jobs
+
+
+def make_figures(figures=None, out_path=None, jobs=1, force=False, render_mode=None, dry_run=False):
+    """
+    Builds the requested figures, skipping those which are up-to-date according to the build manifest (see manifest.py)
+    :param figures: a figure id (see FIGURES) or glob pattern, a list of them, or 'all'; default: the list in do_figures
+    :param out_path: base path for the output files (default: ./out/<datasource>/)
+    :param jobs: number of figures built in parallel, each in its own process
+    :param force: if True, rebuilds all requested figures, even if they are up-to-date
+    :param render_mode: 'interactive' or 'headless' (see helpers.RENDER_MODES); default: headless for 'all',
+                        otherwise RENDER_MODE in settings_data_access.py (default: interactive)
+    :param dry_run: if True, only tells which figures would be built
+    :return: list of (figure id, status, time in seconds, None or error message), in the order of the requested figures;
+             the status is 'ok', 'failed' or 'skipped' (with dry_run: 'to build' or 'skipped')
+    """
+    patterns = [figures] if isinstance(figures, str) else figures or do_figures
+    if not render_mode and 'all' in patterns:
+        render_mode = 'headless'  # Batch run: no windows, no waiting for them to be closed
+    hlp.set_render_mode(render_mode or hlp.render_mode)
+    figures = select_figures(patterns)
+
+    # out_path: the directory of the output files (for each figure, its id is the beginning of the file names)
+    out_path = join(out_path or f"./out/{datasource}/", "")
+
+    # Find which figures need to be built
+    start = perf_counter()
+    manifest = Manifest(out_path)
+    inputs = {}
+    for fig in figures:
+        inputs[fig] = manifest.inputs(FIGURES[fig].function, FIGURES[fig].kwargs(join(out_path, fig)))
+    tobuild = [fig for fig in figures if force or not manifest.is_current(*inputs[fig])]
+    if dry_run:
+        results = [(fig, 'to build' if fig in tobuild else 'skipped', 0.0, None) for fig in figures]
+        print(f"{'Figure':<16}{'Status':<10}Output")
+        for fig, status, duration, error in results:
+            print(f"{fig:<16}{status:<10}{inputs[fig][0]}")
+        return results
+
+    # Get the data for all figures at once (when using the API); forked worker processes inherit it
+    hlp.prefetch([settings_configs.get_settings(dtype=FIGURES[fig].function,
+                                                **FIGURES[fig].kwargs(join(out_path, fig)))
+                  for fig in tobuild])
+
+    if jobs > 1 and len(tobuild) > 1:
+        workers = min(jobs, len(tobuild))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(workers,)) as pool:
+            built = list(pool.map(build_figure, tobuild, [out_path] * len(tobuild)))
     else:
-        figures = [figures]
-
-    # out_path: the full path including the beginning of the file name, which will be extended
-    if not out_path:
-        out_path = f"./out/{datasource}/"
-
-    fig = '5ad'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="SRs+AR6_global_regional", options=['mean', 'median', 'ember'],
-                         out_path=join(out_path, fig),
-                         title="Figure 5(a)+(d): Global vs reg. mean & med.(AR6+SRs, excl. high adapt. and RFCs)")
-
-    fig = '5b'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="SRs+AR6_global_regional", options=['p10-p90'], out_path=join(out_path, fig),
-                         title="Figure 5(b): Global vs regional p10 & p90 (AR6+SRs, excluding high adapt. and RFCs)")
-
-    fig = '5c'
-    if fig in figures or all:
-        cumulative(settings_choice="SRs+AR6noRFCnoHighAdapt", out_path=join(out_path, fig),
-                   title="Figure 5(c): Cumulative distribution of\n"
-                   "transitions mid-points (AR6+SRs, excl. RFCs & high adapt.)")
-
-    fig = '5c-alt'
-    if fig in figures or all:
-        cumulative(settings_choice="SRs+AR6noRFC", out_path=join(out_path, fig),
-                   title="Figure 5(c) - ALT:Cumulative distribution of\ntransitions mid-points (AR6+SRs, excl. RFCs)")
-
-    fig = '5ef'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="SRs+AR6_global_regional", options=['mean', 'median', 'ember', 'wchapter'],
-                         out_path=join(out_path, fig), title="Figure 5(e)+(f) - Global vs regional + chapter weighting")
-
-    fig = '6'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="ecosystems_low-adapt_high-adapt", options=['mean', 'median', 'ember'],
-                         out_path=join(out_path, fig),
-                         title="Figure 6(a)+(b): Ecosystems - others w/o high adapt. - "
-                               "others with high adapt. (AR6+SRs)")
-
-    fig = '6c'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="SRs_vs_AR6-ecosystems", options=['mean', 'median'],
-                         out_path=join(out_path, fig),
-                         title="Figure 6(c): Ecosystems: compare SRs to AR6")
-
-    fig = '6d'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="SRs_vs_AR6-others-no_high-adapt", options=['mean', 'median'],
-                         out_path=join(out_path, fig),
-                         title="Figure 6(d): Other systems: compare SRs to AR6")
-
-    fig = '6c-sup'
-    if fig in figures or all:
-        mean_percentiles(settings_choice="ecosystems_low-adapt_high-adapt_AR6", options=['mean', 'median'],
-                         out_path=join(out_path, fig),
-                         title="Figure 6(sup2): compare SRs to AR6 for human systems\n and ecosystem services, "
-                               "no/mod adaptation")
-
-    fig = '7'
-    if fig in figures or all:
-        overview(settings_choice="overview_systems", out_path=join(out_path, fig),
-                 title="Figure 7: Overview - systems")
-    fig = '7v2'
-    if fig in figures or all:
-        overview(settings_choice="overview_RKRs", out_path=join(out_path, fig),
-                 title="Figure 7v2: Overview - RKRs")
-
-    fig = '8'
-    if fig in figures or all:
-        overview(settings_choice="overview_regions", out_path=join(out_path, fig),
-                 title="Figure 8: Overview - regional")
-    fig = '8-sup'
-    if fig in figures or all:
-        overview(settings_choice="overview_reg_3.5", out_path=join(out_path, fig),
-                 title="Figure 8: Overview - regional - 1.5, 2.5, 3.5°C")
-
-    fig = 'tab3'
-    if fig in figures or all:
-        embers_table(settings_choice="All_included", out_path=join(out_path, fig),
-                     title="Table 3")  # Preprint version (Chapters)
-
-    fig = 'tab3v2'
-    if fig in figures or all:
-        embers_rkr_table(settings_choice="All_included", out_path=join(out_path, fig),
-                         title="Table 3 - version 2")  # Revised manuscript version (RKRs)
-
-    fig = 'tab4'
-    if fig in figures or all:
-        confidence(settings_choice="SRs+AR6_global_regional", out_path=join(out_path, fig),
-                   title="Table 4")
+        built = [build_figure(fig, out_path) for fig in tobuild]
+
+    # Update the manifest
+    for fig, duration, error in built:
+        if not error:
+            manifest.record(*inputs[fig])
+    manifest.save()
+
+    # Summary
+    built = {fig: (fig, 'failed' if error else 'ok', duration, error) for fig, duration, error in built}
+    results = [built.get(fig, (fig, 'skipped', 0.0, None)) for fig in figures]
+    print(f"\n{'Figure':<16}{'Status':<10}Time (s)")
+    for fig, status, duration, error in results:
+        print(f"{fig:<16}{status:<10}{duration:8.1f}")
+    print(f"Total time: {perf_counter() - start:.1f} s with {jobs} job(s)")
+    if jobs == 1 or len(tobuild) == 1:  # Otherwise, each worker process has its own cache
+        stats = hlp.query_cache.stats()
+        print(f"Data cache: {stats['hits']} hit(s), {stats['misses']} miss(es), {stats['evictions']} eviction(s), "
+              f"{stats['entries']} data subset(s) in {stats['bytes'] / (1 << 20):.1f} MB")
+    if len(tobuild) < len(figures):
+        print(f"{len(figures) - len(tobuild)} figure(s) skipped because they are up-to-date (use --force to rebuild)")
+    for fig, status, duration, error in results:
+        if error:
+            print(f"\nFigure {fig} failed:\n{error}")
 
     print("Job completed! Note that a 'processing report' is provided with each figure (.md = Markdown format). "
           "\nFor tables, there are two .md files: the table itself + the processing report.")
+    return results
+
+
+def argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Builds figures and tables (see FIGURES in make_figures.py), skipping those which are up-to-date; "
+                    "alternatively, calls a function building figures with the given settings.",
+        epilog="Examples: python make_figures.py all --jobs 4 | python make_figures.py '5*' tab4 --dry-run | "
+               "python make_figures.py mean_percentiles SRs+AR6_global_regional mean median")
+    parser.add_argument('figures', nargs='*', metavar='figure',
+                        help="figure ids or glob patterns (e.g. '5*'), or 'all' (default: do_figures, in this file); "
+                             "or: <function> <settings_choice> [<option> ...]")
+    parser.add_argument('--list', action='store_true', help="list the available figures")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help="number of figures built in parallel")
+    parser.add_argument('--force', action='store_true', help="rebuild the figures even if they are up-to-date")
+    parser.add_argument('--out', metavar='DIR', help=f"directory of the output files (default: ./out/{datasource}/)")
+    parser.add_argument('--dry-run', action='store_true', help="only tell which figures would be built")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--headless', dest='render_mode', action='store_const', const='headless',
+                       help="only save the figures (default for 'all')")
+    modes.add_argument('--interactive', dest='render_mode', action='store_const', const='interactive',
+                       help="also show each figure in a window")
+    return parser
 
 
-# Optional start from command-line, with arguments
-# Usage:   python make_figures.py  <function to run> <settings_choice> [<option 1> [<option 2>] ...]
-# Example: python make_figures.py  mean_percentiles SRs+AR6_global_regional mean median
-# Alternatively, python make_figures.py <number> would produce a figure based on the numbering in make_figures().
 if __name__ == "__main__":
-    if len(argv) > 2:
-        cmd = f"{argv[1]}(settings_choice='{argv[2]}', options={argv[3:]})"
-        print(cmd)
-        exec(cmd)
+    parser = argument_parser()
+    args = parser.parse_args()
+    if args.list:
+        for fig, figure in FIGURES.items():
+            print(f"{fig:<16}{figure.function:<20}{figure.settings_choice:<40}{figure.title.splitlines()[0]}"
+                  f"{' (optional: not in all)' if figure.optional else ''}")
         exit()
-    elif len(argv) == 2:
-        make_figures(figures=argv[1])
-    else:
-        make_figures()
+    if args.figures and args.figures[0] in FUNCTIONS:
+        # Direct call of a function building figures: <function> <settings_choice> [<option> ...]
+        if len(args.figures) < 2:
+            parser.error(f"a settings choice is required after the function name '{args.figures[0]}'")
+        function, settings_choice, *options = args.figures
+        print(f"{function}(settings_choice='{settings_choice}', options={options})")
+        if not args.dry_run:
+            if args.render_mode:
+                hlp.set_render_mode(args.render_mode)
+            figure_function(function)(settings_choice=settings_choice, options=options,
+                                      **({'out_path': join(args.out, "")} if args.out else {}))
+        exit()
+    try:
+        select_figures(args.figures or do_figures)
+    except ValueError as err:
+        parser.error(str(err))
+    results = make_figures(args.figures, out_path=args.out, jobs=args.jobs, force=args.force,
+                           render_mode=args.render_mode, dry_run=args.dry_run)
+    exit(1 if any(error for fig, status, duration, error in results) else 0)
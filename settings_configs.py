@@ -9,28 +9,61 @@ it is the basis for graphs showing for example the mean for each subset.
 the value of each item in this list is a dict using the same keywords as the parameters defined outside 'multi'
 (e.g. source (= report), title of the graphic...). Keywords outside 'multi' apply to all data subsets.
 """
-from copy import deepcopy
 import inspect
+import warnings
+from copy import deepcopy
+from functools import lru_cache, wraps
+from types import MappingProxyType
 from os import path, makedirs
 
+# Placeholders in the settings table, replaced by the type of diagram and by the options (see settings_table)
+DTYPE = "{dtype}"
+OPTIONS = "{options}"
+
+
+class _FrozenList(tuple):
+    """A list within the frozen settings table (a tuple, which becomes a list again when the settings are resolved)"""
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return _FrozenList(_freeze(item) for item in value)
+    return value
+
 
-def get_settings(settings_choice: str = None, options: list = None, title=None, out_path=None):
+def _resolve(value, dtype: str = None, options_str: str = None):
     """
-    Get settings from edb_paper_settings, selecting a configuration from python call args or CLI.
+    Returns a mutable copy of frozen settings, with the placeholders replaced by the type of diagram and the options
+    (if dtype is None, the settings are only copied)
+    """
+    if isinstance(value, MappingProxyType):
+        return {key: _resolve(item, dtype, options_str) for key, item in value.items()}
+    if isinstance(value, _FrozenList):
+        return [_resolve(item, dtype, options_str) for item in value]
+    if isinstance(value, str) and dtype is not None:
+        return value.replace(DTYPE, dtype).replace(OPTIONS, options_str)
+    return value
 
-    :param settings_choice: the name of the desired settings
-    :param options: a list of options, added to the returned settings
-      - wchapter: apply figure+chapter weighting (if unset, all embers have the same weight)
-      - mean: whether to calculate mean values
-      - ...
-    :param title: A title for the diagram
-    :param out_path: the base path for the output files
-    :returns: selected settings (dict)
+
+def settings_table(dtype: str = '', options_str: str = '') -> dict:
+    """
+    All available settings, by name (settings_choice).
+    A few titles and file names depend on the type of diagram and on the options, which can be provided here.
+
+    :param dtype: the 'type' of diagram (see get_settings)
+    :param options_str: the options, as a string
+    :returns: dict of settings (a new dict on each call: it may be modified by the caller)
     """
-    dtype = inspect.stack()[1][3]  # The 'type' of diagram is the name of the function calling get_settings
-    options = options if options else []
-    options_str = '-'.join(options) if options else ''
+    return _resolve(_frozen_table(), dtype, options_str)
 
+
+@lru_cache(maxsize=1)
+def _frozen_table() -> MappingProxyType:
+    """
+    The settings table, built once and frozen; strings may contain the placeholders DTYPE and OPTIONS.
+    """
     settings = {
         "AR6-WGII": {
             "source": "AR6-WGII",
@@ -86,7 +119,7 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
                       ],
             "title": "Africa(black), Australasia(blue), Europe(red), North-America(orange), Mediterranean(green),"
                      "Polar regions(grey)",
-            "out_file": f"compare_regional_{dtype}",
+            "out_file": f"compare_regional_{DTYPE}",
         },
         "ecosystems_low-adapt_high-adapt": {  # Paper
             "source": " SR1.5-Chapter3 OR SRCCL OR SROCC OR AR6-WGII-Chapter2 OR AR6-WGII",
@@ -102,7 +135,7 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
                        "scenario": "'high adaptation'",
                        "style": ('#02C', '-')},
                       ],
-            "title": f"Ecosystems / others, exc. high adaptation / high adaptation {options_str}",
+            "title": f"Ecosystems / others, exc. high adaptation / high adaptation {OPTIONS}",
             "out_file": f"compare_eco-human-sys",
         },
         "ecosystems_low-adapt_high-adapt_AR6": {  # Paper
@@ -119,7 +152,7 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
                        "scenario": "'high adaptation'",
                        "style": ('#02C', '-')},
                       ],
-            "title": f"Ecosystems / others, exc. high adapt. / high adapt - AR6 only {options_str}",
+            "title": f"Ecosystems / others, exc. high adapt. / high adapt - AR6 only {OPTIONS}",
             "out_file": f"compare_eco-human-sys_AR6",
         },
         "SRs_vs_AR6-ecosystems": {    # Paper
@@ -132,7 +165,7 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
                        "keywords": "'ecosystems' AND NOT 'ecosystem services' AND NOT 'RFC'",
                        "style": ('black', '-')},
                       ],
-            "title": f"Compare SRs to AR6 {options_str}",
+            "title": f"Compare SRs to AR6 {OPTIONS}",
         },
         "SRs_vs_AR6-others-no_high-adapt": {  # Paper-alt
             "multi": [{"name": "SR1.5/SROCC/SRCCL - other systems w/o high adaptation",
@@ -146,7 +179,7 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
                        "scenario": "NOT 'high adaptation'",
                        "style": ('black', '-')},
                       ],
-            "title": f"Compare SRs to AR6 {options_str}",
+            "title": f"Compare SRs to AR6 {OPTIONS}",
         },
         "overview_systems": {   # Paper
             "multi": [
@@ -227,15 +260,65 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
     settings["overview_reg_3.5"]["GMT"] = [1.5, 2.5, 3.5]
     settings["overview_reg_3.5"]["out_file"] = "SRs+AR6_noRFC_overview_reg3.5"
 
-    # Get chosen settings
-    selected_settings = settings[settings_choice]
+    return _freeze(settings)
+
+
+def diagram_type(function):
+    """
+    Decorator for the functions producing a type of diagram: their name is the 'type' of diagram (dtype), which is
+    passed to them as the keyword argument dtype (unless it is given), for get_settings with the other arguments
+    (positional or keyword, e.g. mean_percentiles("SRs+LR", ["wchapter"])).
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        kwargs.setdefault('dtype', function.__name__)
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def get_settings(settings_choice: str = None, options: list = None, title=None, out_path=None, dtype: str = None):
+    """
+    Get settings from edb_paper_settings, selecting a configuration from python call args or CLI.
+    The resolved settings are cached: each call returns a new copy, which may be modified by the caller.
+
+    :param settings_choice: the name of the desired settings
+    :param options: a list of options, added to the returned settings
+      - wchapter: apply figure+chapter weighting (if unset, all embers have the same weight)
+      - mean: whether to calculate mean values
+      - bootstrap: add confidence intervals from bootstrap resampling of the embers (see src/bootstrap.py);
+        bootstrap_levels: also shift the transitions at random within their range, in each resample
+      - ...
+    :param title: A title for the diagram
+    :param out_path: the base path for the output files
+    :param dtype: the 'type' of diagram, which is the name of the function producing it (see diagram_type);
+      if it is not given, the name of the calling function is used (deprecated)
+    :returns: selected settings (dict)
+    """
+    if not dtype:
+        dtype = inspect.currentframe().f_back.f_code.co_name
+        warnings.warn(f"get_settings was called without dtype: '{dtype}' (the calling function) is used; "
+                      f"decorate it with settings_configs.diagram_type or pass dtype", DeprecationWarning, stacklevel=2)
+    options = list(options) if options else []
+    out_path = out_path if out_path else "./out/fig"
+    # Create out directory if it does not exist
+    outdir = path.split(out_path)[0]
+    makedirs(outdir, exist_ok=True)
+    return _resolve(_selected_settings(settings_choice, tuple(options), title, out_path, dtype))
+
+
+@lru_cache(maxsize=None)
+def _selected_settings(settings_choice: str, options: tuple, title, out_path: str, dtype: str) -> MappingProxyType:
+    """
+    The settings selected by get_settings, frozen (see get_settings for the parameters)
+    """
+    options_str = '-'.join(options)
+    selected_settings = settings_table(dtype, options_str)[settings_choice]
 
     # Define outfile for easy identification of the settings within f name.
     if 'out_file' in selected_settings:
         basename = selected_settings["out_file"].strip()
     else:
         basename = settings_choice.strip()
-    out_path = out_path if out_path else "./out/fig"
     settings_in_filename = "_" + dtype + (('_' + options_str) if options_str else '')
     separname = "_" if path.split(out_path)[1] else ""
     selected_settings['out_file'] = (out_path + separname + basename + settings_in_filename).replace(' ', '')
@@ -246,12 +329,7 @@ def get_settings(settings_choice: str = None, options: list = None, title=None,
     elif 'wchapter' in options:
         selected_settings['title'] = selected_settings['title'] + ' (weight/chapter)'
 
-    # Create out directory if it does not exist
-    outdir = path.split(out_path)[0]
-    if not path.exists(outdir):
-        makedirs(outdir)
-
     selected_settings['type'] = dtype
-    selected_settings['options'] = options
+    selected_settings['options'] = list(options)
 
-    return selected_settings
+    return _freeze(selected_settings)
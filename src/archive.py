@@ -0,0 +1,209 @@
+"""
+In-memory store for the embers archive file.
+The archive is parsed and validated once per process; each data request then gets a cheap view of it,
+which can be filtered without re-reading the file (see helpers.jsonfile_get).
+An index of the archive (ArchiveIndex) enables selecting embers with set operations instead of scanning them all.
+Binary archives (see edb_archive.py) are accessed through the same interface.
+"""
+import json
+import hashlib
+from os import path, stat
+from threading import Lock
+from src.textsearch import TextIndex, compile_criteria, normtext
+
+# Data tables expected in an archive file (in addition to 'meta')
+ARCHIVE_TABLES = ('embers', 'figures', 'scenarios', 'biblioreferences')
+
+
+class ArchiveStore:
+    """
+    Keeps the parsed content of an archive file, and reloads it only if the file changed on disk
+    (the modification time and size are checked on each access; the content hash decides whether to reload).
+    """
+    def __init__(self, filename, indexed=True):
+        """
+        :param filename: the archive file
+        :param indexed: whether to build an index of the archive, for faster selection of embers (see index())
+        """
+        self.filename = filename
+        self.indexed = indexed
+        self.hash = None  # sha256 of the file content, as a hex string
+        self._stamp = None  # (modification time, size) of the file when it was last checked
+        self._base = None  # Parsed content; the tables are stored as tuples, so that they can't be modified
+        self._index = None
+        self._lock = Lock()
+
+    def base(self) -> dict:
+        """
+        Returns the parsed archive, reloading it if the file has changed.
+        The returned data is shared: it must not be modified (use view() to get modifiable lists).
+        """
+        st = stat(self.filename)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if stamp != self._stamp:
+                with open(self.filename, "rb") as file:
+                    content = file.read()
+                fhash = hashlib.sha256(content).hexdigest()
+                # If the file was only 'touched', there is no need to parse it again
+                if fhash != self.hash:
+                    self._base = self._parse(content)
+                    self._index = None
+                    self.hash = fhash
+                self._stamp = stamp
+            return self._base
+
+    def view(self) -> dict:
+        """
+        Returns the archive content in the same form as json.load would provide it, except that
+        the dicts within the tables (embers, figures...) are shared with the store and should be regarded as read-only.
+        The lists and the 'meta' dict are new objects, which can be filtered or modified by the caller.
+        """
+        base = self.base()
+        data = {key: list(base[key]) for key in ARCHIVE_TABLES}
+        data['meta'] = dict(base['meta']) if base['meta'] else base['meta']
+        return data
+
+    def index(self):
+        """
+        Returns the index of the current archive content (built on first use after each reload),
+        or None if indexing is disabled or not possible (ember ids are not unique).
+        """
+        base = self.base()
+        with self._lock:
+            if self.indexed and (self._index is None or self._index.base is not base):
+                try:
+                    self._index = ArchiveIndex(base)
+                except ValueError:
+                    self.indexed = False
+                    self._index = None
+            return self._index
+
+    def records(self, embers) -> list:
+        """
+        Returns the complete records of the given embers (from base() or view()), in the json format of archive files;
+        the embers of an archive file are already complete (unlike those of a binary archive, see edb_archive.py).
+        """
+        return list(embers)
+
+    def _parse(self, content: bytes) -> dict:
+        try:
+            jsondata = json.loads(content)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"Could not read the archive file '{self.filename}': {err}")
+        if type(jsondata) is not dict:
+            raise ValueError(f"Invalid archive file '{self.filename}': the top level should be a json object")
+        for key in ARCHIVE_TABLES:
+            if type(jsondata.get(key)) is not list:
+                raise ValueError(f"Invalid archive file '{self.filename}': '{key}' should be a list")
+        base = {key: tuple(jsondata[key]) for key in ARCHIVE_TABLES}
+        base['meta'] = jsondata.get('meta')
+        return base
+
+
+class ArchiveIndex:
+    """
+    Inverted indexes of the words in the ember longnames and keywords, in the citation keys of the references and in the
+    names of scenarios, with the mappings needed to follow the relations from references and scenarios to embers.
+    select() applies the same filtering rules as helpers.filter_embers, using set operations on ids.
+    """
+    def __init__(self, base):
+        self.base = base
+        embers = base['embers']
+        self.position = {be['id']: ipos for ipos, be in enumerate(embers)}
+        if len(self.position) != len(embers):
+            raise ValueError("Ember ids are not unique: the archive cannot be indexed")
+        self.strids = {str(beid): beid for beid in self.position}
+        self.longname = TextIndex((be['id'], be['longname']) for be in embers)
+        self.keywords = TextIndex((be['id'], be['keywords']) for be in embers)
+        self.cite_key = TextIndex((bib['id'], bib['cite_key']) for bib in base['biblioreferences'])
+        self.scenario = TextIndex((scen['id'], scen['name']) for scen in base['scenarios'])
+        # Relations, as {id: set of related ids}
+        self.inclusion = self._group((int(be['inclusion_level']), be['id']) for be in embers)
+        self.by_figure = self._group((be['mainfigure_id'], be['id']) for be in embers)
+        self.by_scenario = self._group((be['scenario_id'], be['id']) for be in embers)
+        self.crossrefs = self._group((bib['crossref_id'], bib['id']) for bib in base['biblioreferences'])
+        self.figs_by_bib = self._group((fig['biblioreference_id'], fig['id']) for fig in base['figures'])
+        self._included = {}  # Ids of the embers retained for each inclusion level (cache)
+
+    @staticmethod
+    def _group(pairs) -> dict:
+        groups = {}
+        for key, value in pairs:
+            groups.setdefault(key, set()).add(value)
+        return groups
+
+    def _related(self, relation: dict, keys) -> set:
+        return set().union(*(relation.get(key, ()) for key in keys))
+
+    def _embers(self, ids) -> list:
+        return [self.base['embers'][ipos] for ipos in sorted(self.position[beid] for beid in ids)]
+
+    def select(self, **kwargs) -> list:
+        """
+        Returns the list of embers matching the criteria, in the order of the archive.
+        :param kwargs: search/filter criteria, as for helpers.jsonfile_get
+        """
+        ilev = int(kwargs["inclusion"]) if "inclusion" in kwargs else 0
+        if ilev not in self._included:
+            levels = [lev for lev in self.inclusion if lev >= ilev]
+            self._included[ilev] = frozenset(self._related(self.inclusion, levels))
+        included = self._included[ilev]
+
+        # Embers added through their ids, regardless of the other criteria (see filter_embers)
+        if "emberids" in kwargs:
+            bes = {self.strids[sid] for sid in kwargs["emberids"].split('-') if sid in self.strids} & included
+        else:
+            bes = None
+
+        selected = included
+        filtered = False
+        if "longname" in kwargs:
+            selected = selected & compile_criteria(kwargs["longname"]).select(self.longname)
+            filtered = True
+
+        if "source" in kwargs:
+            query = compile_criteria(kwargs["source"])
+            bibids = query.select(self.cite_key)
+            bibids = bibids | self._related(self.crossrefs, bibids)
+            figids = self._related(self.figs_by_bib, bibids)
+            if query.match(normtext("")):
+                figids.add(None)
+            selected = selected & self._related(self.by_figure, figids)
+            filtered = True
+
+        if "keywords" in kwargs:
+            selected = selected & compile_criteria(kwargs["keywords"]).select(self.keywords)
+            filtered = True
+
+        if "scenario" in kwargs:
+            query = compile_criteria(kwargs["scenario"])
+            scids = set(query.select(self.scenario))
+            if query.match(normtext("")):
+                scids.add(None)
+            selected = selected & self._related(self.by_scenario, scids)
+            filtered = True
+
+        if bes:
+            if filtered:
+                return self._embers(bes - selected) + self._embers(selected)
+            return self._embers(bes)
+        return self._embers(selected)
+
+
+# Stores for the archive files used in this process, by absolute file name
+_stores = {}
+
+
+def get_store(filename) -> ArchiveStore:
+    """
+    Returns the store for the given archive file (created on first use); a directory is a binary archive.
+    """
+    key = path.abspath(filename)
+    if key not in _stores:
+        if path.isdir(filename):
+            from src.edb_archive import EdbStore  # (imported here, as edb_archive depends on this module)
+            _stores[key] = EdbStore(filename)
+        else:
+            _stores[key] = ArchiveStore(filename)
+    return _stores[key]
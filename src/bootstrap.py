@@ -0,0 +1,236 @@
+"""
+Bootstrap (Monte-Carlo) estimate of the uncertainty of the aggregated curves and embers from mean_percentiles,
+activated by the option 'bootstrap'.
+Each resample draws the embers with replacement and, with the option 'bootstrap_levels', moves each transition at random
+within its assessed range; the mean and median curves and the aggregated transitions are then calculated as for the full
+data set, and the spread among resamples provides confidence intervals.
+Resamples are processed in chunks of fixed size, each with its own random generator derived from the seed, and run in
+a pool of processes: the results depend on the seed, not on the number of processes.
+Settings (in settings_configs, all optional):
+  - bootstrap_n: number of resamples (default 1000)
+  - bootstrap_seed: seed of the random generator (default 0)
+  - bootstrap_ci: width of the confidence intervals, in % (default 90)
+  - bootstrap_jobs: number of processes (default: number of CPUs, shared with the other figures built in parallel by
+    make_figures, see helpers.figure_jobs)
+The confidence intervals of the transitions of the aggregated ember take the resamples in which a level is not reached
+(within the hazard levels) into account: they are ranked above all others, and a limit which falls among them is inf
+(shown as 'not reached').
+"""
+import warnings
+import numpy as np
+from os import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+import src.helpers as hlp
+from src.ember_arrays import EmberArrays, interp_rows
+
+CHUNK = 50  # Number of resamples in each task of the process pool
+# Points of the transitions of the aggregated ember for which the uncertainty is reported:
+# {name: position in transition}
+TRANS_POINTS = {'tmin': 0.001, 'p50': 0.5, 'tmax': 0.999}
+TRANS_NAMES = ('undetectable to moderate', 'moderate to high', 'high to very high')
+
+
+class BootstrapData:
+    """
+    The data needed to calculate resamples (kept small, as it is sent to each process of the pool).
+    """
+    def __init__(self, lbes, hazlevs, exprisk=False, median=True, jitter=False):
+        ebs = EmberArrays(lbes)
+        self.hazlevs = np.asarray(hazlevs)
+        self.weights = np.array([be.ext['weight'] for be in lbes], dtype=float)
+        self.exprisk = exprisk
+        self.median = median  # Whether the aggregated ember is based on the median (otherwise, on the mean)
+        self.jitter = jitter
+        self.hazl, self.risk, self.nlev, self.itrans = ebs.hazl, ebs.risk, ebs.nlev, ebs.itrans
+        self.haz_valid_top = ebs.haz_valid_top
+        self.ntrans = ebs.ntrans
+        # Half of the hazard range of each transition (embers x transitions), as the maximum shift of the transitions
+        valid = np.arange(self.hazl.shape[1])[None, :] < self.nlev[:, None]
+        self.halfwidth = np.zeros((len(lbes), self.ntrans))
+        for itr in range(self.ntrans):
+            intrans = valid & (self.itrans == itr)
+            with np.errstate(invalid='ignore'):
+                width = np.max(np.where(intrans, self.hazl, -np.inf), axis=1) \
+                    - np.min(np.where(intrans, self.hazl, np.inf), axis=1)
+            self.halfwidth[:, itr] = np.where(intrans.any(axis=1), width / 2.0, 0.0)
+        # Without jitter, the risk of each ember does not change: it is calculated once
+        if not jitter:
+            self.risk_matrix = ebs.risk_matrix(self.hazlevs)
+            self.included = ebs.haz_top[:, None] >= self.hazlevs[None, :]
+
+    def resample(self, rng):
+        """
+        Draws a resample of the embers, and returns their risk at each hazard level and the matrix of included values
+        """
+        nbe = len(self.weights)
+        idx = rng.integers(0, nbe, nbe)
+        if not self.jitter:
+            return self.risk_matrix[idx], self.included[idx], self.weights[idx]
+        # Shift each transition by a random fraction of its half-width, then restore the order of the levels
+        shifts = rng.uniform(-1.0, 1.0, (nbe, self.ntrans)) * self.halfwidth[idx]
+        hazl = self.hazl[idx] + np.take_along_axis(shifts, self.itrans[idx], axis=1)
+        hazl = np.maximum.accumulate(hazl, axis=1)
+        nlev = self.nlev[idx]
+        trmax = hazl[np.arange(nbe), nlev - 1]
+        included = np.maximum(trmax, self.haz_valid_top[idx])[:, None] >= self.hazlevs[None, :]
+        return interp_rows(self.hazlevs, hazl, self.risk[idx], nlev), included, self.weights[idx]
+
+
+def curves(risk, included, weights, exprisk=False):
+    """
+    Weighted mean and median of the risk among the included embers, at each hazard level (as in mean_percentiles.aggreg)
+    :return: mean, median (nan where no ember is included)
+    """
+    wincl = np.where(included, weights[:, None], 0.0)
+    values = 2**risk if exprisk else risk
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(included, values * wincl, 0.0).sum(axis=0) / wincl.sum(axis=0)
+        if exprisk:
+            mean = np.log2(mean)
+    median = hlp.weighted_percentile_columns(risk, 50.0, weights, mask=included)
+    return mean, median
+
+
+def translevels(emberbase, hazlevs):
+    """
+    Hazard levels of the points listed in TRANS_POINTS, for each transition of the aggregated ember based on emberbase
+    :return: array (transitions x points), nan for risk levels which are not reached
+    """
+    defined = ~np.isnan(emberbase)
+    base, hazl = emberbase[defined], np.asarray(hazlevs)[defined]
+    levels = np.full((len(TRANS_NAMES), len(TRANS_POINTS)), np.nan)
+    if len(base):
+        for itr in range(len(TRANS_NAMES)):
+            for ipt, pos in enumerate(TRANS_POINTS.values()):
+                if itr + pos < base[-1]:
+                    levels[itr, ipt] = np.interp(itr + pos, base, hazl)
+    return levels
+
+
+def percentiles_not_reached(values, limits):
+    """
+    Percentiles along the first axis (resamples), with the same linear interpolation as np.percentile, where nan means
+    'not reached': such values are ranked above all others, and a percentile falling among them is inf
+    """
+    ranked = np.sort(np.where(np.isnan(values), np.inf, values), axis=0)
+    pos = np.asarray(limits, dtype=float) / 100.0 * (len(ranked) - 1)
+    ilow = np.floor(pos).astype(int)
+    ihigh = np.minimum(ilow + 1, len(ranked) - 1)
+    frac = (pos - ilow).reshape((-1,) + (1,) * (ranked.ndim - 1))
+    low, high = ranked[ilow], ranked[ihigh]
+    with np.errstate(invalid='ignore'):
+        lerp = np.where(frac >= 0.5, high - (high - low) * (1 - frac), low + (high - low) * frac)  # As np.percentile
+        return np.where(frac == 0, low, np.where(np.isinf(high), np.inf, lerp))
+
+
+def draw_transitions(ax, bands, color):
+    """
+    Draws the confidence intervals of the transitions of the aggregated ember, as horizontal whiskers on the curve
+    from which it is calculated, at each point of TRANS_POINTS
+    :param ax: the axes of the x-y plot (hazard levels x risk levels)
+    :param bands: as returned by bootstrap
+    :param color: the colour of the curve
+    """
+    xmax = bands['hazlevs'][-1]
+    for itr in range(len(TRANS_NAMES)):
+        for ipt, pos in enumerate(TRANS_POINTS.values()):
+            level, low, high = bands['levels'][itr, ipt], bands['trans'][0][itr, ipt], bands['trans'][1][itr, ipt]
+            if np.isnan(level):
+                continue
+            # A limit which is not reached (inf) is drawn up to the end of the hazard levels, without cap
+            ax.errorbar(level, itr + pos, xerr=[[level - low], [min(high, xmax) - level]], color=color,
+                        linewidth=0.8, capsize=0 if high > xmax else 2.5, marker='|', markersize=5)
+
+
+def resamples(data: BootstrapData, seed, nres):
+    """
+    Calculates nres resamples, using a random generator initialised from seed
+    :return: means, medians (resamples x hazard levels), transition levels (resamples x transitions x points)
+    """
+    rng = np.random.default_rng(seed)
+    means = np.empty((nres, len(data.hazlevs)))
+    medians = np.empty((nres, len(data.hazlevs)))
+    trans = np.empty((nres, len(TRANS_NAMES), len(TRANS_POINTS)))
+    for ires in range(nres):
+        risk, included, weights = data.resample(rng)
+        means[ires], medians[ires] = curves(risk, included, weights, data.exprisk)
+        trans[ires] = translevels(medians[ires] if data.median else means[ires], data.hazlevs)
+    return means, medians, trans
+
+
+_worker_data = None  # Data of the current bootstrap, in each process of the pool
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _worker_resamples(seed, nres):
+    return resamples(_worker_data, seed, nres)
+
+
+def bootstrap(lbes, hazlevs, dset, emberbase):
+    """
+    Runs the bootstrap for a data subset and reports the confidence intervals of the aggregated ember.
+    :param lbes: list of embers, with their weight in be.ext['weight'] (see mean_percentiles.aggreg)
+    :param hazlevs: hazard levels at which the curves are calculated
+    :param dset: settings for the current data subset
+    :param emberbase: the curve on which the aggregated ember is based (median or mean of the full data set)
+    :return: dict with the lower and upper limits of the confidence intervals: 'mean' and 'median' (each a pair of
+             arrays, one value per hazard level), and 'trans' (pair of arrays, transitions x points, inf if not
+             reached); 'levels': the transitions of the aggregated ember (transitions x points), and 'hazlevs'
+    """
+    nres = int(dset.get('bootstrap_n', 1000))
+    seed = dset.get('bootstrap_seed', 0)
+    cilevel = float(dset.get('bootstrap_ci', 90))
+    jobs = dset.get('bootstrap_jobs') or max(1, (cpu_count() or 1) // hlp.figure_jobs)
+    if nres < 1:
+        raise ValueError(f"bootstrap_n should be at least 1 (received: {nres})")
+    jitter = 'bootstrap_levels' in dset['options']
+    data = BootstrapData(lbes, hazlevs, exprisk=dset.get('exprisk', False), median='median' in dset['options'],
+                         jitter=jitter)
+
+    # Chunks of resamples, each with its own seed
+    sizes = [min(CHUNK, nres - start) for start in range(0, nres, CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if jobs == 1 or len(sizes) == 1:
+        results = [resamples(data, chseed, size) for chseed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(sizes)), initializer=_init_worker,
+                                 initargs=(data,)) as pool:
+            results = list(pool.map(_worker_resamples, seeds, sizes))
+    means, medians, trans = (np.concatenate(res) for res in zip(*results))
+
+    # Confidence intervals
+    limits = ((100.0 - cilevel) / 2.0, (100.0 + cilevel) / 2.0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # All-nan slices (e.g. a risk level never reached)
+        bands = {'mean': np.nanpercentile(means, limits, axis=0),
+                 'median': np.nanpercentile(medians, limits, axis=0)}
+    bands['trans'] = percentiles_not_reached(trans, limits)
+    bands['levels'] = translevels(emberbase, hazlevs)
+    bands['hazlevs'] = np.asarray(hazlevs)
+    ndefined = np.sum(~np.isnan(trans), axis=0)
+
+    # Report
+    hlp.report.write(f"Bootstrap: {cilevel:g}% confidence intervals", title=2)
+    hlp.report.write(f"{nres} resamples of the {len(lbes)} embers (seed: {seed}), "
+                     f"{'with' if jitter else 'without'} random shifts of the transitions within their range.")
+    hlp.report.write(f"Transitions: the resamples in which a level is not reached (below {hazlevs[-1]:g}°C) "
+                     f"are ranked above all others; a limit which falls among them is shown as 'not reached'.")
+    hlp.report.table_head("Transition", "Point", "Level", "CI low", "CI high", "Reached in resamples")
+
+    def limit(value):
+        return "not reached" if np.isinf(value) else f"{value:.2f}"
+    for itr, trname in enumerate(TRANS_NAMES):
+        for ipt, point in enumerate(TRANS_POINTS):
+            hlp.report.table_write(trname, point, f"{bands['levels'][itr, ipt]:.2f}",
+                                   limit(bands['trans'][0][itr, ipt]), limit(bands['trans'][1][itr, ipt]),
+                                   f"{ndefined[itr, ipt]}/{nres}")
+    hlp.report.table_head("GMT", "Mean: CI low", "Mean: CI high", "Median: CI low", "Median: CI high")
+    for lev, hazl in enumerate(hazlevs):
+        if abs(hazl * 2.0 - round(hazl * 2.0)) < 1e-6 and hazl > 0:  # Report at each 0.5°C
+            hlp.report.table_write(f"{hazl:.1f}", *(f"{bands[curve][side][lev]:.2f}"
+                                                    for curve in ('mean', 'median') for side in (0, 1)))
+    return bands
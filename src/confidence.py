@@ -3,17 +3,20 @@ import src.helpers as hlp
 import settings_configs
 
 
-def confidence(**kwargs):
+@settings_configs.diagram_type
+def confidence(*args, **kwargs):
     """
     Table of confidence levels (Markdown)
     """
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    settings = settings_configs.get_settings(**kwargs)
+    settings = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     hlp.report_start(settings)
+    # Get the data for all data subsets at once, rather than waiting for each request in the loop below
+    hlp.prefetch([settings])
 
     # Create the summary table (Simple md files are crated by the small "Report" class)
-    tableout = hlp.Report(settings['out_file'] + '_out.md')
+    tableout = hlp.open_document(settings['out_file'] + '_out.md')
     bins = 0.5 + np.arange(5)
     tableout.write(f"Confidence range bins limits: {bins}")
 
@@ -42,7 +45,7 @@ def confidence(**kwargs):
             # Get confidence index for these
             confs = [be.trans[itr].confidence_index for be in bes]
             # Get corresponding hazard level for mean and median (at risk levels 0.5, 1.5, and 2.5)
-            haz = [hlp.hfn(be, itr + 0.5) for be in bes]
+            haz = hlp.hfn_batch(bes, [itr + 0.5])[:, 0]
             haz50 = np.percentile(haz, 50.0, method='linear')
             # Count embers in each bin
             hist = np.histogram(confs, bins=bins)  # bins are also created for 'low to med' etc.
@@ -0,0 +1,65 @@
+"""
+Consistency check for the bulk download mode (API_BULK, see remote.py): for each data subset defined in
+settings_configs.py, compares the embers selected locally from the bulk download with those selected by the server.
+The check requires access to the API (API_URL in settings_data_access).
+Usage: python -m src.consistency [<settings_choice> ...]
+"""
+import json
+from sys import argv, exit
+import settings_configs
+import src.helpers as hlp
+from src.remote import get_client, bulk_archive
+from settings_data_access import API_URL, TOKEN
+
+
+def check_consistency(choices=None) -> list:
+    """
+    :param choices: names of the settings to check (see settings_configs.settings_table); default: all
+    :return: list of differences, as dicts (settings, dset, request, only_local, only_server, order, error);
+             'order' is True if the same embers are selected, but in a different order;
+             'error' is the error message if the data subset could not be selected, locally or by the server
+    """
+    if not API_URL:
+        raise ValueError("The consistency check requires access to the API (API_URL in settings_data_access.py)")
+    table = settings_configs.settings_table()
+    archive = bulk_archive(API_URL, TOKEN)
+    client = get_client(TOKEN)
+    differences = []
+    ndsets = 0
+    for choice in choices or table:
+        for dset in hlp.DSets(table[choice]):
+            ndsets += 1
+            request = hlp.api_request(dset)
+            diff = {'settings': choice, 'dset': dset['idset'], 'request': request,
+                    'only_local': [], 'only_server': [], 'order': False, 'error': None}
+            response = client.get(request)
+            try:
+                local = [be['id'] for be in hlp.jsonfile_get(archive, **dset).content['embers']]
+            except ValueError as err:
+                local = None
+                diff['error'] = f"local selection failed: {err}"
+            if not response.ok:
+                diff['error'] = (diff['error'] + "; " if diff['error'] else "") + \
+                                f"server selection failed with status {response.status_code}"
+            elif local is not None:
+                server = [be['id'] for be in json.loads(response.content)['embers']]
+                if local == server:
+                    continue
+                diff.update(only_local=sorted(set(local) - set(server)),
+                            only_server=sorted(set(server) - set(local)),
+                            order=set(local) == set(server))
+            differences.append(diff)
+    print(f"Checked {ndsets} data subsets: {len(differences)} difference(s) or error(s)")
+    for diff in differences:
+        if diff['error']:
+            detail = diff['error']
+        elif diff['order']:
+            detail = "different order"
+        else:
+            detail = f"only in local selection: {diff['only_local']}, only in server selection: {diff['only_server']}"
+        print(f"- {diff['settings']}, data subset {diff['dset']} ({diff['request']}): {detail}")
+    return differences
+
+
+if __name__ == "__main__":
+    exit(1 if check_consistency(argv[1:]) else 0)
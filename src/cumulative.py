@@ -2,8 +2,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import src.helpers as hlp
 import settings_configs
+from src.ember_arrays import EmberArrays, levels_view
+from src.report import DETAIL
 
-def cumulative(**kwargs):
+@settings_configs.diagram_type
+def cumulative(*args, **kwargs):
     """
     Cumulative distribution of mid-points within transitions.
     Arguments are passed to get_settings:
@@ -12,9 +15,11 @@ def cumulative(**kwargs):
     """
 
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    settings = settings_configs.get_settings(**kwargs)
+    settings = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     hlp.report_start(settings)
+    # Get the data for all data subsets at once, rather than waiting for each request in the loop below
+    hlp.prefetch([settings])
     # Create plot
     fig, ax = plt.subplots()
 
@@ -39,36 +44,31 @@ def cumulative(**kwargs):
             rlev.append((1.001, '#DC0', '--'))
             rlev.append((1.999, 'red', '--'))
 
+        # Optional 'per chapter' weighting (see helpers.set_weights); the distribution is in % of the total weight
+        figures = data['figures_by_id'] if 'wchapter' in dset['options'] else None
+        weights = hlp.set_weights(lbes, figures)
+
+        # Hazard levels corresponding to each risk level, for all embers (embers x risk levels)
+        ebs = EmberArrays(lbes)
+        hazs = ebs.hazard_matrix([rl[0] for rl in rlev], pointwise=True)
+        # haz_top = maximum hazard level for which there is an indication that the assessment considered it:
+        #   - haz_valid[1] is the stated top of the assessment, but
+        #   - a transition above haz_valid[1] is also regarded as an indication that it was considered.
+        #     (= better than entirely removing the ember).
+        included = hazs < ebs.haz_top[:, None]
+
         # Loop over the risk levels for which a distribution is plotted
-        for rl in rlev:
-            haz_chg = []
+        for irl, rl in enumerate(rlev):
             hlp.report.write(f"Processing risk level {rl[0]}", title=2)
+            for ibe in np.nonzero(~included[:, irl])[0] if hlp.report.enabled(DETAIL) else ():
+                be = lbes[ibe]
+                maxass = levels_view(be).haz_top
+                hlp.report.write(f"Ember '{be.longname}' ({be.id}) excluded because max."
+                                 f" risk level is {hlp.rfn(be, maxass)} (max. hazard = {maxass}°C).", level=DETAIL)
+            hlp.report.write(f"Total number of embers included: {np.count_nonzero(included[:, irl])}")
 
-            for be in lbes:
-                # Hazard level corresponding to the risk level rl[0] (= associated to the currently prepared curve)
-                haz = hlp.hfn(be, rl[0])
-                # maxass = maximum hazard level for which there is an indication that the assessment considered it:
-                #   - haz_valid[1] is the stated top of the assessment, but
-                #   - a transition above haz_valid[1] is also regarded as an indication that it was considered.
-                #     (= better than entirely removing the ember).
-                maxass = max(np.max(be.levels_values('hazl')), be.haz_valid[1])
-                if haz < maxass:
-                    haz_chg.append(haz)
-                else:
-                    hlp.report.write(f"Ember '{be.longname}' ({be.id}) excluded because max."
-                                     f" risk level is {hlp.rfn(be, maxass)} (max. hazard = {maxass}°C).")
-            hlp.report.write(f"Total number of embers included: {len(haz_chg)}")
-
-            haz_chg = np.sort(haz_chg)
-            neb = 0
-            xx = []
-            yy = []
-            for hc in haz_chg:
-                xx.append(hc)
-                yy.append(neb)
-                neb += 100.0 / len(lbes)
-                xx.append(hc)
-                yy.append(neb)
+            xx, yy = hlp.cumulative_steps(hazs[included[:, irl], irl], weights[included[:, irl]],
+                                          total=np.sum(weights))
             lstyle = ('-', '--')[dset["idset"]] if dset["ndsets"] > 1 else rl[2]
             ax.plot(xx, yy, color=rl[1], linestyle=lstyle)
 
@@ -80,5 +80,5 @@ def cumulative(**kwargs):
 
     plt.rcParams['svg.fonttype'] = 'none'
     fig.savefig(f"{settings['out_file']}.pdf", format="pdf")
-    plt.show()
+    hlp.show_figure(fig)
     hlp.report.close()
@@ -7,9 +7,10 @@ import json
 import helpers as hlp
 logger = emaker_hlp.Logger()
 
-def draw_all_embers(**kwargs):
+@settings_configs.diagram_type
+def draw_all_embers(*args, **kwargs):
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    dset = settings_configs.get_settings(**kwargs)
+    dset = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     hlp.report_start(dset)
     hlp.report.write(f"Source {dset['idset']}: {dset['name']}", title=1)
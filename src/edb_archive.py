@@ -0,0 +1,156 @@
+"""
+Binary archive format: a directory (usually named *.edb) converted from a json archive file, which can be opened
+without parsing the levels of all embers:
+ - meta.json contains the 'meta' data, the reference tables (figures, scenarios, biblioreferences), the embers
+   and their transitions without the levels and confidence levels (which are None), and the lists of level labels and
+   confidence levels;
+ - numpy arrays (.npy files), memory-mapped when the archive is opened:
+   ember_trans: index of the first transition of each ember, followed by the total number of transitions,
+   trans_levels: index of the first level of each transition, followed by the total number of levels,
+   trans_conf: confidence level of each transition (index in the list of confidence levels, -1 if none),
+   level_hazl: hazard value of each level (nan if none),
+   level_label: label of each level (index in the list of labels, such as 'min' or 'median').
+The complete records of embers, in the json format of archive files, are only rebuilt for the selected embers
+(EdbStore.records). The values of levels are rebuilt as floats.
+The format is only partly columnar: the levels are, but the other fields of embers and transitions (e.g. names, keywords
+and scenarios) remain json objects in meta.json, which is parsed when the archive is opened (it is usually the
+largest part of the archive). These records are what the selection (ArchiveStore.view, helpers.filter_embers) works on.
+Conversion: python -m src.edb_archive <archive file> [<binary archive directory>]
+"""
+import json
+import hashlib
+from os import path, stat, replace, getpid, makedirs
+from shutil import rmtree
+from sys import argv, exit
+import numpy as np
+from src.archive import ArchiveStore, ARCHIVE_TABLES, get_store
+
+EDB_FORMAT = 1
+META = "meta.json"
+ARRAYS = {'ember_trans': np.int64, 'trans_levels': np.int64, 'trans_conf': np.int8,
+          'level_hazl': np.float64, 'level_label': np.int16}
+
+
+class EdbStore(ArchiveStore):
+    """
+    Keeps the content of a binary archive (reloaded if it was converted again), with the interface of ArchiveStore;
+    the embers in base() have no levels: use records() to get complete embers.
+    """
+    def __init__(self, filename, indexed=True):
+        super().__init__(filename, indexed)
+        self._arrays = None
+        self._rows = None  # Position of each ember in the arrays, by id() of its dict in base()
+        self._transitions = None
+        self._labels = None
+        self._confidences = None
+
+    def base(self) -> dict:
+        metafile = path.join(self.filename, META)
+        st = stat(metafile)
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if stamp != self._stamp:
+                with open(metafile, "rb") as file:
+                    content = file.read()
+                try:
+                    meta = json.loads(content)
+                except json.JSONDecodeError as err:
+                    raise ValueError(f"Could not read the binary archive '{self.filename}': {err}")
+                if meta.get('format') != EDB_FORMAT:
+                    raise ValueError(f"Binary archive '{self.filename}' has an unsupported format: "
+                                     f"convert the archive file again")
+                # meta.json contains the hash of the arrays, so that its own hash identifies the whole archive
+                self.hash = hashlib.sha256(content).hexdigest()
+                self._base = {key: tuple(meta[key]) for key in ARCHIVE_TABLES}
+                self._base['meta'] = meta['meta']
+                self._transitions = meta['transitions']
+                self._labels = meta['labels']
+                self._confidences = meta['confidences']
+                self._arrays = {name: np.load(path.join(self.filename, name + ".npy"), mmap_mode='r')
+                                for name in ARRAYS}
+                self._rows = {id(be): irow for irow, be in enumerate(self._base['embers'])}
+                self._index = None
+                self._stamp = stamp
+            return self._base
+
+    def records(self, embers) -> list:
+        """
+        Returns the complete records of the given embers (from base() or view()), in the json format of archive files
+        """
+        self.base()
+        arrays = self._arrays
+        records = []
+        for be in embers:
+            irow = self._rows[id(be)]
+            itr0, itr1 = arrays['ember_trans'][irow:irow + 2].tolist()
+            ilev = arrays['trans_levels'][itr0:itr1 + 1].tolist()
+            confs = arrays['trans_conf'][itr0:itr1].tolist()
+            hazls = arrays['level_hazl'][ilev[0]:ilev[-1]].tolist()
+            labels = arrays['level_label'][ilev[0]:ilev[-1]].tolist()
+            transitions = []
+            for itr in range(itr1 - itr0):
+                trans = dict(self._transitions[itr0 + itr])
+                if 'confidence' in trans:
+                    trans['confidence'] = self._confidences[confs[itr]] if confs[itr] >= 0 else None
+                levs = range(ilev[itr] - ilev[0], ilev[itr + 1] - ilev[0])
+                trans['levels'] = {self._labels[labels[ipos]]: hazls[ipos] if hazls[ipos] == hazls[ipos] else None
+                                   for ipos in levs}
+                transitions.append(trans)
+            records.append(dict(be, transitions=transitions))
+        return records
+
+
+def convert_archive(filename, target=None) -> str:
+    """
+    Converts a json archive file to a binary archive
+    :param filename: the json archive file
+    :param target: the binary archive directory (default: the name of the archive file, with extension .edb)
+    :return: the name of the binary archive directory
+    """
+    target = target or path.splitext(filename)[0] + ".edb"
+    base = get_store(filename).base()
+    labels, confidences = {}, {}
+    embers, transitions = [], []
+    columns = {name: [] for name in ARRAYS}
+    for be in base['embers']:
+        columns['ember_trans'].append(len(transitions))
+        embers.append(dict(be, transitions=None))
+        for trans in be['transitions']:
+            columns['trans_levels'].append(len(columns['level_hazl']))
+            conf = trans.get('confidence')
+            columns['trans_conf'].append(confidences.setdefault(conf, len(confidences)) if conf is not None else -1)
+            transitions.append(dict(trans, levels=None, **({'confidence': None} if 'confidence' in trans else {})))
+            for label, hazl in trans['levels'].items():
+                columns['level_label'].append(labels.setdefault(label, len(labels)))
+                columns['level_hazl'].append(np.nan if hazl is None else hazl)
+    columns['ember_trans'].append(len(transitions))
+    columns['trans_levels'].append(len(columns['level_hazl']))
+
+    # Written in a temporary directory which then replaces the target, as other processes may be reading it
+    tmpdir = f"{target}.{getpid()}.tmp"
+    makedirs(tmpdir)
+    sha = hashlib.sha256()
+    for name, dtype in ARRAYS.items():
+        array = np.array(columns[name], dtype=dtype)
+        np.save(path.join(tmpdir, name + ".npy"), array)
+        sha.update(array.tobytes())
+    meta = {'format': EDB_FORMAT, 'source': path.basename(filename), 'source_hash': get_store(filename).hash,
+            'arrays_hash': sha.hexdigest(), 'meta': base['meta'],
+            'labels': list(labels), 'confidences': list(confidences), 'transitions': transitions, 'embers': embers}
+    meta.update({key: base[key] for key in ARCHIVE_TABLES if key != 'embers'})
+    with open(path.join(tmpdir, META), "w", encoding='utf8') as file:
+        json.dump(meta, file, ensure_ascii=False)
+    if path.exists(target):
+        oldname = f"{target}.{getpid()}.old"
+        replace(target, oldname)
+        replace(tmpdir, target)
+        rmtree(oldname)
+    else:
+        replace(tmpdir, target)
+    return target
+
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        exit("Usage: python -m src.edb_archive <archive file> [<binary archive directory>]")
+    print(f"Binary archive written to '{convert_archive(*argv[1:3])}'")
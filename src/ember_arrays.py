@@ -0,0 +1,222 @@
+"""
+Array representations of the levels of embers:
+- LevelsView: the levels of one ember as numpy arrays, cached within the ember (see levels_view);
+- EmberArrays: the levels of a list of embers, packed in padded 2-D arrays (one row per ember), so that, for example,
+  the risk of all embers can be interpolated at many hazard levels in one operation (see mean_percentiles.aggreg).
+"""
+import numpy as np
+from bisect import bisect_right
+
+# Confidence levels, from lowest to highest (the confidence of a level is its index in this list, see confidence_code)
+CONFIDENCE_LEVELS = ('L', 'LM', 'M', 'MH', 'H', 'HVH', 'VH')
+
+
+def interp_rows(x, xp, fp, nlev, pointwise=False):
+    """
+    Row-wise linear interpolation: for each row i, gives the same result as np.interp(x, xp[i, :n], fp[i, :n])
+    with n = nlev[i], including for values outside the data range and for repeated data points.
+    :param x: values at which to interpolate: 1-D array (the same for all rows) or 2-D array (one row per row of xp)
+    :param xp: 2-D array of the data points, padded with +inf after the nlev[i] valid values of each row
+    :param fp: 2-D array of the data values (same shape as xp)
+    :param nlev: 1-D array, number of valid data points in each row (at least 1)
+    :param pointwise: if True, the result for rows which are not sorted is that of np.interp called separately for each
+                      value of x (with unsorted data points, the result of np.interp depends on the order of x)
+    :return: 2-D array of interpolated values, of shape (number of rows in xp, number of values in x)
+    """
+    x = np.asarray(x, dtype=float)
+    nrows = xp.shape[0]
+    xx = np.broadcast_to(x, (nrows, x.shape[-1])) if x.ndim == 1 else x
+    last = (np.asarray(nlev) - 1)[:, None]
+
+    # Index of the last data point <= x (-1 if there is none); for sorted data points, this is what np.interp finds
+    # (the loop is done over the data points or the interpolated values, whichever is shorter)
+    j = np.full(xx.shape, -1, dtype=np.intp)
+    if xp.shape[1] <= xx.shape[1]:
+        for col in range(xp.shape[1]):
+            j += xp[:, col:col + 1] <= xx
+    else:
+        for col in range(xx.shape[1]):
+            j[:, col] += np.sum(xp <= xx[:, col:col + 1], axis=1)
+    j = np.minimum(j, last)
+    j0 = np.maximum(j, 0)
+    j1 = np.minimum(j0 + 1, last)
+    x0 = np.take_along_axis(xp, j0, axis=1)
+    x1 = np.take_along_axis(xp, j1, axis=1)
+    y0 = np.take_along_axis(fp, j0, axis=1)
+    y1 = np.take_along_axis(fp, j1, axis=1)
+
+    # Same formula as in np.interp, including its fallback when the result is not a number
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y1 - y0) / (x1 - x0)
+        res = slope * (xx - x0) + y0
+        nans = np.isnan(res)
+        if nans.any():
+            alt = slope * (xx - x1) + y1
+            alt = np.where(np.isnan(alt) & (y0 == y1), y0, alt)
+            res = np.where(nans, alt, res)
+    res = np.where(x0 == xx, y0, res)
+    res = np.where(j == last, y0, res)  # At or above the last data point
+    res = np.where(j < 0, fp[:, :1], res)  # Below the first data point
+    res = np.where(np.isnan(xx) & (last > 0), xx, res)  # np.interp returns fp[0] for nan if there is only one point
+
+    # np.interp requires sorted data points: rows which are not sorted are left to np.interp for identical results
+    with np.errstate(invalid='ignore'):
+        unsorted = np.nonzero(np.any(np.diff(xp, axis=1) < 0, axis=1))[0]
+    for row in unsorted:
+        if pointwise:
+            res[row] = [np.interp(value, xp[row, :nlev[row]], fp[row, :nlev[row]]) for value in xx[row]]
+        else:
+            res[row] = np.interp(xx[row], xp[row, :nlev[row]], fp[row, :nlev[row]])
+    return res
+
+
+def column_groups(mask):
+    """
+    Groups the columns of a boolean matrix by their number of True values, so that the selected values in each group
+    can be processed as a regular (dense) array; used to get column-wise results identical to those obtained
+    by processing each column separately.
+    :param mask: 2-D boolean array (rows x columns)
+    :return: list of (columns, n), where columns is an array of column indexes, all having n True values
+    """
+    counts = mask.sum(axis=0)
+    return [(np.nonzero(counts == n)[0], int(n)) for n in np.unique(counts)]
+
+
+def compress_columns(values, mask, columns, n):
+    """
+    Selects the values where mask is True within the given columns, which must all have n True values.
+    :return: 2-D array (one row for each column, containing its n selected values in their original order)
+    """
+    return values[:, columns].T[mask[:, columns].T].reshape(len(columns), n)
+
+
+def confidence_code(trans) -> int:
+    """
+    Code of the (first) confidence level of a transition: its index in CONFIDENCE_LEVELS,
+    -1 if the transition has no confidence level, or -2 if the confidence level is not known
+    """
+    if not trans.confidence:
+        return -1
+    return CONFIDENCE_LEVELS.index(trans.confidence[0]) if trans.confidence[0] in CONFIDENCE_LEVELS else -2
+
+
+class LevelsView:
+    """
+    The levels of one ember as read-only numpy arrays, with values derived from them (see levels_view)
+    """
+    __slots__ = ('key', 'hazl', 'risk', 'itrans', 'conf', 'hazl_max', 'haz_valid_top', 'haz_top')
+
+    def __init__(self, be, key):
+        counts = [len(tr.levels) for tr in be.trans]
+        if not sum(counts):
+            raise ValueError(f"Ember '{be.name}' has no levels: it cannot be processed")
+        self.key = key
+        self.hazl = be.levels_values('hazl')
+        self.risk = be.levels_values('risk')
+        # Index of the transition containing each level, within the ember
+        self.itrans = np.repeat(np.arange(len(counts)), counts)
+        # Confidence level of the transition containing each level (see confidence_code)
+        self.conf = np.repeat([confidence_code(tr) for tr in be.trans], counts).astype(np.intp)
+        for array in (self.hazl, self.risk, self.itrans, self.conf):
+            array.flags.writeable = False
+        self.hazl_max = np.max(self.hazl)
+        self.haz_valid_top = be.haz_valid[1]
+        # Top of the assessed hazard range: highest hazard level of a transition, or top of the validity range if higher
+        self.haz_top = max(self.hazl_max, self.haz_valid_top)
+
+
+def levels_view(be) -> LevelsView:
+    """
+    Returns the levels of an ember as arrays; they are only calculated again if the ember changed in a way which
+    may change its levels: conversion of the hazard variable, validity range, or any change of the transitions
+    (name, confidence, or the phase or hazard level of their levels).
+    :param be: an ember
+    """
+    key = (be.haz_name_std, tuple(be.haz_valid),
+           tuple((tr.name, tuple(tr.confidence or ()), tuple(tuple(dict.items(lv)) for lv in tr.levels))
+                 for tr in be.trans))
+    view = getattr(be, '_levels_view', None)
+    if view is None or view.key != key:
+        view = LevelsView(be, key)
+        be._levels_view = view
+    return view
+
+
+class EmberArrays:
+    """
+    Levels of a list of embers, packed in padded arrays (one row per ember, padded with +inf).
+    """
+    def __init__(self, lbes):
+        self.embers = lbes
+        views = [levels_view(be) for be in lbes]
+        self.nlev = np.array([len(view.hazl) for view in views], dtype=np.intp)
+        width = int(self.nlev.max()) if len(lbes) else 1
+        self.hazl = np.full((len(lbes), width), np.inf)
+        self.risk = np.full((len(lbes), width), np.inf)
+        # Index of the transition containing each level, within its ember (0 for the padding)
+        self.itrans = np.zeros((len(lbes), width), dtype=np.intp)
+        # Confidence level of each level (see confidence_code; -1 for the padding)
+        self.conf = np.full((len(lbes), width), -1, dtype=np.intp)
+        for ibe, view in enumerate(views):
+            self.hazl[ibe, :len(view.hazl)] = view.hazl
+            self.risk[ibe, :len(view.risk)] = view.risk
+            self.itrans[ibe, :len(view.itrans)] = view.itrans
+            self.conf[ibe, :len(view.conf)] = view.conf
+        self.ntrans = max((len(be.trans) for be in lbes), default=0)
+        # Top of the assessed hazard range: highest hazard level of a transition, or top of the validity range if higher
+        self.trmax = np.array([view.hazl_max for view in views])
+        self.haz_valid_top = np.array([view.haz_valid_top for view in views], dtype=float)
+        self.haz_top = np.maximum(self.trmax, self.haz_valid_top)
+
+    def __len__(self):
+        return len(self.embers)
+
+    def risk_matrix(self, hazls, pointwise=False):
+        """
+        Risk index of each ember at each of the given hazard levels (same as helpers.rfn for each ember and level)
+        :param hazls: 1-D array of hazard levels
+        :param pointwise: see interp_rows
+        :return: 2-D array (embers x hazard levels)
+        """
+        return interp_rows(hazls, self.hazl, self.risk, self.nlev, pointwise)
+
+    def hazard_matrix(self, risks, pointwise=False):
+        """
+        Hazard level of each ember at each of the given risk indexes (same as helpers.hfn for each ember and risk index)
+        :param risks: 1-D array of risk indexes
+        :param pointwise: see interp_rows
+        :return: 2-D array (embers x risk indexes)
+        """
+        return interp_rows(risks, self.risk, self.hazl, self.nlev, pointwise)
+
+    def confidence_matrix(self, hazls):
+        """
+        Confidence at each of the given hazard levels (same as helpers.rfn with conf=True for each ember and level):
+        the lowest confidence of the levels just below and just above the hazard level, as an index in
+        CONFIDENCE_LEVELS, or -1 if one of them has no confidence level.
+        :param hazls: 1-D array of hazard levels
+        :return: 2-D array of integers (embers x hazard levels)
+        """
+        hazls = np.asarray(hazls, dtype=float)
+        # Position of the first level above each hazard level, as found by bisect_right
+        idx1 = np.zeros((len(self), len(hazls)), dtype=np.intp)
+        for col in range(self.hazl.shape[1]):
+            idx1 += (self.hazl[:, col:col + 1] <= hazls) & (col < self.nlev[:, None])
+        idx1[:, np.isnan(hazls)] = self.nlev[:, None]
+        # The result of bisect_right depends on its search path when the levels are not sorted
+        with np.errstate(invalid='ignore'):
+            unsorted = np.any(np.diff(self.hazl, axis=1) < 0, axis=1)
+            irregular = np.nonzero(unsorted | np.any(np.isnan(self.hazl), axis=1))[0]
+        for row in irregular:
+            idx1[row] = [bisect_right(self.hazl[row, :self.nlev[row]].tolist(), hazl) for hazl in hazls]
+
+        idx1 = np.minimum(idx1, self.nlev[:, None] - 1)
+        idx0 = np.maximum(idx1 - 1, 0)
+        conf0 = np.take_along_axis(self.conf, idx0, axis=1)
+        conf1 = np.take_along_axis(self.conf, idx1, axis=1)
+        missing = (conf0 == -1) | (conf1 == -1)
+        unknown = ((conf0 == -2) | (conf1 == -2)) & ~missing
+        if unknown.any():
+            be = self.embers[np.nonzero(unknown)[0][0]]
+            raise ValueError(f"Unknown confidence level in ember '{be.name}' (known levels: {CONFIDENCE_LEVELS})")
+        return np.where(missing, -1, np.minimum(conf0, conf1))
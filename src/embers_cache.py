@@ -0,0 +1,91 @@
+"""
+Persistent cache of the embers of an archive file after conversion of their hazard variable to GMT
+(see helpers.extractdata).
+The converted embers are stored as plain data: for each ember, its record in the json format of the archive
+(with converted hazard levels), whether the conversion succeeded, and the conversion log, so that the processing
+reports remain the same. Ember objects are created from these records for each request, so that callers never share
+them.
+The cache is kept in memory and in CACHE_DIR (from settings_data_access; default './cache'; None = in memory only);
+it is identified by the hash of the archive content, the conversion mode (conv_gmt) and the version of EmberMaker.
+When a cache file is written, the files of the same archive (by name) and conversion mode which were based on another
+version of the archive or of EmberMaker are removed.
+"""
+import glob
+import pickle
+import hashlib
+from os import path, makedirs, replace, getpid, remove
+from importlib.metadata import version, PackageNotFoundError
+import settings_data_access
+
+CACHE_DIR = getattr(settings_data_access, 'CACHE_DIR', './cache')
+
+# Converted embers, by cache key
+_converted = {}
+
+
+def embermaker_version() -> str:
+    try:
+        return version('embermaker')
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+def _digest(value, size) -> str:
+    return hashlib.sha256(repr(value).encode()).hexdigest()[:size]
+
+
+def prune(prefix, current):
+    """
+    Removes the cache files starting with prefix other than current (other versions of the same archive file),
+    and the files named before the prefix was introduced (embers_<key>.pickle)
+    """
+    stale = glob.glob(glob.escape(prefix) + "*.pickle") \
+        + glob.glob(path.join(glob.escape(CACHE_DIR), "embers_" + "?" * 32 + ".pickle"))
+    for filename in stale:
+        if filename != current:
+            try:
+                remove(filename)
+            except OSError:  # E.g. already removed by another process
+                pass
+
+
+def converted_embers(store, conv_gmt: str, convert) -> dict:
+    """
+    Returns the converted embers of an archive, from the cache if available, otherwise by converting all embers.
+    :param store: the ArchiveStore of the archive file
+    :param conv_gmt: the conversion mode (see helpers.extractdata)
+    :param convert: function converting the record of an ember, returning (converted record, success, log)
+    :return: dict {ember id: (converted record, success, log)}; the records must not be modified
+    """
+    base = store.base()
+    key = (store.hash, conv_gmt, embermaker_version())
+    if key in _converted:
+        return _converted[key]
+
+    filename = None
+    converted = None
+    if CACHE_DIR:
+        # Name: embers_<archive file and conversion mode>_<key>.pickle
+        prefix = path.join(CACHE_DIR, f"embers_{_digest((path.abspath(store.filename), conv_gmt), 16)}_")
+        filename = f"{prefix}{_digest(key, 32)}.pickle"
+        try:
+            with open(filename, "rb") as file:
+                content = pickle.load(file)
+            if content['key'] == key:
+                converted = content['embers']
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            converted = None
+
+    if converted is None:
+        converted = {jsbe['id']: convert(jsbe) for jsbe in store.records(base['embers'])}
+        if filename:
+            # Written under a temporary name then renamed, as other processes may be reading or writing the same file
+            makedirs(CACHE_DIR, exist_ok=True)
+            tmpname = f"{filename}.{getpid()}.tmp"
+            with open(tmpname, "wb") as file:
+                pickle.dump({'key': key, 'embers': converted}, file, protocol=pickle.HIGHEST_PROTOCOL)
+            replace(tmpname, filename)
+            prune(prefix, filename)
+
+    _converted[key] = converted
+    return converted
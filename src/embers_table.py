@@ -5,11 +5,12 @@ from collections import Counter
 import src.helpers as hlp
 import settings_configs
 import re
-import pandas as pd
 logger = embhlp.Logger()  # Standard log function in EmberMaker
 
 
 def get_fig_sortkey(biblioreferences):
+    bibrefs_by_key = {br['cite_key']: br for br in biblioreferences}
+
     def fig_sortkey(fig):
         """
         Sort key for figures in a chronological + chapter report order
@@ -21,7 +22,7 @@ def get_fig_sortkey(biblioreferences):
         figkeys = fignum.split(".")
         figinrep = figkeys[1] if len(figkeys) > 1 else 0
         figinrep = int(re.sub('[^0-9]', '', str(figinrep)))
-        rep = [br for br in biblioreferences if br['cite_key'] == fig['biblioreference_cite_key']][0]
+        rep = bibrefs_by_key[fig['biblioreference_cite_key']]
         chapter = rep['chapter']
         if chapter is None:  # Try to get an integer from the first part of the figure number
             try:  # Reject CCPs ect. et end of list, after chapters
@@ -33,7 +34,8 @@ def get_fig_sortkey(biblioreferences):
     return fig_sortkey
 
 
-def embers_table(**kwargs):
+@settings_configs.diagram_type
+def embers_table(*args, **kwargs):
     """
     Generates a summary table for 'all' embers, by chapter.
     'All' normally refers to the "included" embers, that is, those with the included field >= 0;
@@ -42,7 +44,7 @@ def embers_table(**kwargs):
     :return:
     """
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    settings = settings_configs.get_settings(**kwargs)
+    settings = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     # Note: this is the generic processing report, its content is not the same as the summary table generated here.
     #       the processing report list all embers included in the table + shows conversions to GMT
@@ -62,14 +64,18 @@ def embers_table(**kwargs):
     # (in practice: this removes the SRCCL - "sup mat" figures, which are not in the report,
     #  and the TAR SPM; this will need to be adjusted if new embers beyond AR6 are added)
     figures = [fig for fig in data['figures'] if fig['id'] in embers_figids]
-    scenarios = data['scenarios']
+    scenarios = data['scenarios_by_id']
 
     dbes = {be.id: be for be in lbes}
+    # Ids of the embers in each figure
+    figs_be_ids = {}
+    for be in embers:
+        figs_be_ids.setdefault(be.meta['mainfigure_id'], []).append(be.id)
 
     fig_sortkey = get_fig_sortkey(biblioreferences)
     figures.sort(key=fig_sortkey)
     # Create the summary table (Simple md files are crated by the small "Report" class)
-    tableout = hlp.Report(settings['out_file']+'_out.md')
+    tableout = hlp.open_document(settings['out_file'] + '_out.md')
     tableout.table_head("Report: main figure", "*shortname* <br/> (title)", "#other adapt.", "#high adapt.", "#total",
                         "High risk at mean T (min, max)")
 
@@ -82,7 +88,7 @@ def embers_table(**kwargs):
     hlp.report.table_head("Report", "Figure number", "Source")
     for fig in figures:
         hlp.report.table_write(fig['biblioreference_cite_key'], fig['number'], fig['biblioreference'])
-        be_ids = [be.id for be in embers if be.meta['mainfigure_id'] == fig['id']]
+        be_ids = figs_be_ids.get(fig['id'], [])
         n_other_adap = 0
         n_high_adap = 0
         c_all = 0
@@ -91,6 +97,9 @@ def embers_table(**kwargs):
         hr_mid = []
         be_gmt = True
         be_haz_names = set()
+        # Hazard levels at the middle, start and end of the transition to high risk, for the embers of this figure
+        found_ids = [beid for beid in be_ids if beid in dbes]
+        hazs = dict(zip(found_ids, hlp.hfn_batch([dbes[beid] for beid in found_ids], [1.5, 1.0001, 1.9999])))
 
         for beid in be_ids:
             try:
@@ -99,11 +108,12 @@ def embers_table(**kwargs):
                 logger.addwarn(f"Could not find ember! id: {beid} figure: {fig}")
                 continue
             c_all += 1
-            hr_mid.append(hlp.hfn(be, 1.5))
-            hr_bot = min(hr_bot, hlp.hfn(be, 1.0001))
-            hr_top = max(hr_top, hlp.hfn(be, 1.9999))
+            haz_mid, haz_bot, haz_top = hazs[beid]
+            hr_mid.append(haz_mid)
+            hr_bot = min(hr_bot, haz_bot)
+            hr_top = max(hr_top, haz_top)
             if be.meta['scenario_id']:
-                if hlp.dict_by_id(scenarios, be.meta['scenario_id'])["name"] == "High adaptation":
+                if scenarios[be.meta['scenario_id']]["name"] == "High adaptation":
                     n_high_adap += 1
                 else:
                     n_other_adap += 1
@@ -124,7 +134,8 @@ def embers_table(**kwargs):
     tableout.close(total=False)
 
 
-def embers_rkr_table(**kwargs):
+@settings_configs.diagram_type
+def embers_rkr_table(*args, **kwargs):
     """
     Produces a summary table for embers grouped by key risk (RKR) category.
     The table contains the "included" embers, that is, those with the included field >= 0;
@@ -132,8 +143,9 @@ def embers_rkr_table(**kwargs):
     :param kwargs:
     :return:
     """
+    import pandas as pd  # Only needed for this table: not imported with the module
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    settings = settings_configs.get_settings(**kwargs)
+    settings = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     # Note: this is the generic processing report, its content is not the same as the summary table generated here.
     #       the processing report list all embers included in the table + shows conversions to GMT
@@ -146,8 +158,10 @@ def embers_rkr_table(**kwargs):
     data = hlp.getdata(dset)
 
     embers = data['embers']
-    figures = data['figures']
+    figures = data['figures_by_id']
     bibrefs = data['biblioreferences']
+    bibrefs_by_id = data['biblioreferences_by_id']
+    cite_keys = data['figure_cite_key']
     bibrefs.sort(key=lambda br: int(br['year'])*100+(br['chapter'] if br['chapter'] is not None else 0))
 
     for be in embers:
@@ -162,7 +176,7 @@ def embers_rkr_table(**kwargs):
     gbes = [(g[0], list(g[1])) for g in groupby(embers, hlp.rkr_sortkey)]
     
     # Create the summary table
-    tableout = hlp.Report(settings['out_file']+'_out.md')
+    tableout = hlp.open_document(settings['out_file'] + '_out.md')
     tableout.table_head("RKR category", "#Embers", "Adapt. variants",
                         "High risk at mean T (min, max)")
 
@@ -181,7 +195,8 @@ def embers_rkr_table(**kwargs):
         cat = hlp.RKRCATS6[idx]
 
         c_all = 0
-        hr_mid = []
+        # GMT at the mid-point of the transition to high risk, for the embers based on GMT
+        hr_mid = list(hlp.hfn_batch([be for be in gbe if be.haz_name_std == "GMT"], [1.5])[:, 0])
         non_gmt_names = []
         bibrefs_ids = []
 
@@ -192,20 +207,17 @@ def embers_rkr_table(**kwargs):
             else:
                 add_cats = '-'
             hlp.report.table_write(cat, add_cats, be.longname,
-                                   hlp.dict_by_id(figures, be.meta["mainfigure_id"])['biblioreference_cite_key'],
+                                   cite_keys[be.meta["mainfigure_id"]],
                                    be.id)
             c_all += 1
-            # Calcultate GMT at the mid-point of the transition to high risk,
-            if be.haz_name_std == "GMT":
-                hr_mid.append(hlp.hfn(be, 1.5))
-                # Note: the first version calculated to full range for this transition (= start -> end of transition);
-                # this was removed in the revised paper for simplicity / to avoid potential confusion.
-                # What is now calculated is the min/max of the *mid-point* (only) across embers in a category.
-            else:
+            # Note: the first version calculated to full range for the transition to high risk (= start -> end of
+            # transition); this was removed in the revised paper for simplicity / to avoid potential confusion.
+            # What is now calculated is the min/max of the *mid-point* (only) across embers in a category (hr_mid).
+            if be.haz_name_std != "GMT":
                 non_gmt_names.append(be.haz_name_std)
 
             figid = be.meta['mainfigure_id']
-            bibref_id = hlp.dict_by_id(figures, figid)['biblioreference_id']
+            bibref_id = figures[figid]['biblioreference_id']
             bibrefs_ids.append(bibref_id)
             rkr_chap_cnt.at[cat, bibref_id] += 1
 
@@ -247,7 +259,7 @@ def embers_rkr_table(**kwargs):
     tableout.table_write("Total", gt_c_all, f'{gt_risks_multi} / {gt_risks_tot}', "")
 
     tableout.write(" ")
-    cols = [hlp.dict_by_id(bibrefs, bid)['cite_key'] for bid in rkr_chap_cnt.columns]
+    cols = [bibrefs_by_id[bid]['cite_key'] for bid in rkr_chap_cnt.columns]
     tableout.table_head("RKR category", *cols, 'All chapters')
     for cat in rkr_chap_cnt.index:
         rowvals = rkr_chap_cnt.loc[cat, :]
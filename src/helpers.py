@@ -1,22 +1,52 @@
 from typing import Iterator
+import sys
 import json
 import numpy as np
-import requests
-from embermaker.embergraph import EmberGraph
-from embermaker.readembers import embers_from_json
-from embermaker.helpers import Logger
-import matplotlib.pyplot as plt
-from matplotlib import colors
 import logging
-from bisect import bisect_right
+from copy import deepcopy
+from itertools import groupby
+from collections import Counter
+import settings_data_access
 from settings_data_access import API_URL, TOKEN, FILE
-from os import path, makedirs
-import re
+from os import path, makedirs, environ
+from functools import lru_cache
+from src.archive import get_store
+from src.embers_cache import converted_embers
+from src.json_stream import read_archive, write_json, ARCHIVE_STREAMING
+from src.remote import get_client, bulk_archive, API_BULK
+from src.query_cache import query_cache, query_key, source_stamp
+from src.report import Report, CurrentReport, open_report, open_document, DETAIL
+from src.textsearch import compile_criteria, normtext
+from src.ember_arrays import EmberArrays, interp_rows, column_groups, compress_columns, levels_view
+# Note: EmberMaker and matplotlib are only imported by the functions which need them, so that importing this module
+# (e.g. to build a table from the data) stays fast.
+
+
+@lru_cache(maxsize=1)
+def risk_graph():
+    """
+    Returns a dumb ember graph, created on first use, because this provides access to the risk level index
+    (e.g. for interpolation); also available as helpers.egr.
+    (the origin of this is that risk names, indexes, and colours are defined at the graph level in EmberMaker;
+     this may change in a future version of EmberMaker, if it gets a specific management of risk level definitions)
+    """
+    from embermaker.embergraph import EmberGraph
+    return EmberGraph()
+
+
+def __getattr__(name):
+    if name == 'egr':
+        return risk_graph()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
-# Create a dumb ember graph because this provides access to the risk level index (e.g. for interpolation);
-# (the origin of this is that risk names, indexes, and colours are defined at the graph level in EmberMaker;
-#  this may change in a future version of EmberMaker, if it gets a specific management of risk level definitions)
-egr = EmberGraph()
+
+# Render mode: 'interactive' (each figure is shown in a window after being saved, waiting until it is closed)
+# or 'headless' (figures are only saved, with a non-interactive backend); see set_render_mode
+RENDER_MODES = ('interactive', 'headless')
+render_mode = getattr(settings_data_access, 'RENDER_MODE', 'interactive')
+# Number of figures built in parallel by make_figures, each in its own process: processes started by a figure
+# (e.g. for the bootstrap) share the CPUs with the other figures
+figure_jobs = 1
 
 
 def weighted_percentile(values, p, weights=None):
@@ -48,6 +78,131 @@ def weighted_percentile(values, p, weights=None):
     return np.interp(percent, wrank, values)
 
 
+def weighted_percentile_columns(values, p, weights=None, mask=None):
+    """ Weighted percentiles of each column of a matrix, with the same definition (C = 1/2) as weighted_percentile;
+    the result for each column is identical to that of weighted_percentile applied to the valid values of the column.
+    :param values: 2-D array (samples x columns), e.g. the risk of each ember (rows) at each hazard level (columns)
+    :param p: scalar or sequence of p-th percentile(s) for which to compute the percentile value
+    :param weights: array-like with one weight per sample (row)
+    :param mask: optional boolean array of the same shape as values, False for values to be ignored
+    :return: numpy.array with computed percentiles, of shape (len(p), number of columns), or (number of columns)
+             if p is a scalar; nan for columns without valid values
+    """
+    values = np.asarray(values, dtype=float)
+    percent = np.array(p) / 100.0
+    if weights is None:
+        weights = np.ones(values.shape[0])
+    weights = np.broadcast_to(np.asarray(weights, dtype=float)[:, None], values.shape)
+    if mask is None:
+        mask = np.ones(values.shape, dtype=bool)
+    assert np.all(percent >= 0) and np.all(percent <= 1), \
+        'percentiles should be in [0, 100]'
+
+    result = np.full((values.shape[1], percent.size), np.nan)
+    # Columns with the same number of valid values are sorted and interpolated together
+    for columns, nvals in column_groups(mask):
+        if nvals == 0:
+            continue
+        cvalues = compress_columns(values, mask, columns, nvals)
+        cweights = compress_columns(weights, mask, columns, nvals)
+        sorter = np.argsort(cvalues, axis=1)
+        cvalues = np.take_along_axis(cvalues, sorter, axis=1)
+        cweights = np.take_along_axis(cweights, sorter, axis=1)
+
+        wrank = np.cumsum(cweights, axis=1) - 0.5 * cweights  # (C = 1/2)
+        wrank /= np.sum(cweights, axis=1)[:, None]
+        result[columns] = interp_rows(percent.ravel(), wrank, cvalues, np.full(len(columns), nvals))
+    return result[:, 0] if percent.ndim == 0 else result.T
+
+
+def set_render_mode(mode):
+    """
+    Sets the render mode (see RENDER_MODES); in headless mode, matplotlib uses the (non-interactive) Agg backend,
+    which is kept if the interactive mode is set later in the same process.
+    """
+    global render_mode
+    if mode not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode '{mode}': should be one of {RENDER_MODES}")
+    if mode == 'headless':
+        if 'matplotlib' in sys.modules:
+            sys.modules['matplotlib'].use('Agg')
+        else:
+            environ['MPLBACKEND'] = 'Agg'  # Used when (and if) matplotlib is imported
+    render_mode = mode
+
+
+def show_figure(fig):
+    """
+    Shows the figure in interactive mode (waiting until its window is closed), then closes it to free its memory;
+    the figure should be saved before.
+    """
+    import matplotlib.pyplot as plt
+    if render_mode == 'interactive':
+        plt.show()
+    plt.close(fig)
+
+
+def close_figures():
+    """
+    Closes all figures, if matplotlib was used
+    """
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+
+def cumulative_steps(values, weights=None, total=None):
+    """ Step curve of the cumulative distribution of values, in % of the total weight
+    :param values: 1-D array of values
+    :param weights: array-like with one weight per value (default: 1)
+    :param total: the weight corresponding to 100%, which may include values left out of the distribution
+                  (default: the sum of weights)
+    :return: x and y coordinates of the curve (2 points per value: before and after its step)
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float)
+    total = np.sum(weights) if total is None else total
+    sorter = np.argsort(values, kind='stable')
+    cumul = np.concatenate(([0.0], np.cumsum(100.0 * weights[sorter] / total)))
+    return np.repeat(values[sorter], 2), np.column_stack((cumul[:-1], cumul[1:])).ravel()
+
+
+def set_weights(lbes, figures=None):
+    """ Sets the weight of each ember, in be.ext['weight']
+    :param lbes: list of burning embers
+    :param figures: dict of figures by id, containing data about each figure, for weighting 'per chapter/figure'
+                    (reported in the processing report); None => each ember has a weight of 1
+    :return: array of the weights
+    """
+    if figures:
+        report.write(f"Weighting per chapter/figure (n total={len(lbes)})", title=2)
+        report.table_head("Weighting group", "Embers", "Weight")
+        # Calculate weights: 'equal weight per chapter/figure' option
+        # (weighting per chapter is the rule, per figure is applied to SRCCL and SR1.5, due to differences in scope)
+        # Create a dict that will link the id of each ember (the key) to the label of its weighting group:
+        be_groups = dict()
+        for be in lbes:
+            # Get information about the main figure containing ember be:
+            figinfo: dict = figures[be.meta['mainfigure_id']]
+            # Generate and set the group label for each ember
+            if figinfo['biblioreference_cite_key'] in ('SRCCL', 'SR1.5'):  # Exception: split by figure
+                be_groups[be.id] = figinfo['biblioreference_cite_key'] + '-' + str(figinfo['number'])
+            else:
+                be_groups[be.id] = figinfo['biblioreference_cite_key']
+
+        groups_count = Counter(be_groups.values())
+        for group_key, be_set in groupby(lbes, lambda xbe: be_groups[xbe.id]):
+            weight = 1.0 / groups_count[group_key]
+            names = ""
+            for be in be_set:
+                be.ext['weight'] = weight
+                names += f"{be.longname}({be.id});<br>"
+            report.table_write(group_key, names, f"{weight:5.2f}")
+    else:
+        for be in lbes:
+            be.ext['weight'] = 1.0
+    return np.array([be.ext['weight'] for be in lbes], dtype=float)
+
+
 class DSets:
     """
     An iterator over the data subsets (dsets) given the current full settings;
@@ -110,11 +265,38 @@ def request_param_str(dset, param: str):
         return ""
 
 
+def api_request(dset, desc=False) -> str:
+    """
+    Returns the url of the API request for the data subset dset.
+    :param dset: the settings defining which data to retrieve (see getdata)
+    :param desc: if True, includes the description of embers and transitions
+    """
+    request_param_str.first = True
+    return (f"{API_URL}/api/combined_data"
+            + request_param_str(dset, 'emberids')
+            + request_param_str(dset, 'source')
+            + request_param_str(dset, 'keywords')
+            + request_param_str(dset, 'scenario')
+            + request_param_str(dset, 'longname')
+            + request_param_str(dset, 'inclusion')
+            + (request_param_str({"desc": ""}, 'desc') if desc else ""))
+
+
+def prefetch(settings_list, desc=False):
+    """
+    Gets the data for all data subsets of the given settings concurrently, before they are processed,
+    so that getdata then takes it from memory. Only useful for the API without API_BULK: otherwise, does nothing.
+    :param settings_list: a list of settings (as from get_settings), which are not modified
+    :param desc: as for getdata
+    """
+    if not API_URL or API_BULK:
+        return
+    get_client(TOKEN).prefetch([api_request(dset, desc=desc)
+                                for settings in settings_list for dset in DSets(deepcopy(settings))])
+
+
 def jsonfile_save(filename, data):
-    received_json = json.dumps(data, indent=4, ensure_ascii=False)
-    filename = path.splitext(filename)[0] + '.json'
-    with open(filename, "w", encoding='utf8') as outfile:
-        outfile.write(received_json)
+    write_json(path.splitext(filename)[0] + '.json', data)
 
 
 class Response:
@@ -135,6 +317,7 @@ def stringmatch(criteria, text):
       (because that is the same as the PostgreSQL text search used by the remote API)
     - plural and singular are considered equivalent, again because PostgreSQL does this.
       (implementation might be a bit rough: it just ignores the character 's' when at end of a word)
+    - the criteria are parsed once and memoised, and each text is normalised once (see textsearch.py)
 
     :param text: the text to check for matches according to the criteria
     :param criteria: the search criteria
@@ -142,105 +325,104 @@ def stringmatch(criteria, text):
     """
     if not criteria:
         return True
-    if '!' in criteria or '&' in criteria or '|' in criteria:
-        raise Exception('Stringmatch: &,|,! are not allowed; please use the AND/OR/NOT syntax for boolean operators')
-
-    # Parse the criteria to get a list of tuples: [(<string to find>,<operator>), ...]
-    pexp = re.findall(r"(|\b[^']*?\b|\'.*?\') *(\(|\)|\bAND\b|\bOR\b|\bNOT\b|$)", criteria)
-    lstr = ""
-    # Character 'translation' tool to replace all white spaces with standard spaces
-    blanks = str.maketrans("\t\n\r\x0b\x0c\xa0", "      ")
-    # Regex to insert blanks as word boundaries
-    wordbounds = r'([.,;-])'
-    # Get string to search within, with all word boundaries
-    ptext = " " + re.sub(wordbounds, r' \1 ', text).translate(blanks).lower() + " "
-    # Ignore plural forms = just remove 's' when at end of a word.
-    ptext = ptext.replace("s ", " ")
-    for ex in pexp:
-        # Get a fragment of the search expression to look for in text
-        tx = ex[0].lower().translate(blanks).strip().strip("'")
-        if tx:
-            # apply to the search fragment the same processing as for text:
-            tx = re.sub(wordbounds, r' \1 ', f" {tx} ").replace("s ", " ")
-            fnd = str(tx in ptext) + " "
-        else:
-            fnd = ""
-        lstr += " " + fnd + ex[1].lower()
-    try:
-        return eval(lstr)
-    except SyntaxError:
-        raise Exception(f"Stringmatch failed to apply '{criteria}' to '{text}'")
+    return compile_criteria(criteria).match(normtext(text))
 
 
-def jsonfile_get(filename, **kwargs):
+def filter_embers(jsondata, **kwargs):
     """
-    Returns the filtered content of a json file according to the combination of criteria defined in dset
-    Search/filter expressions may contain the boolean operators AND/OR/NOT, but cannot use &/|/!.
-
-    :param filename: Full name of the json input file
-    :keyword: Search/filter criteria (see Embers_retreive_API.md).
-                     In this software, it is usually provided as part of the 'data set parameters' (dset).
-    :return: A dict of ember-related data, containing embers and other data read from the input file.
+    Returns the list of embers from jsondata (ember-related data, as in an archive file) which match the criteria.
+    :param jsondata: a dict containing the embers, figures, scenarios and biblioreferences
+    :keyword: Search/filter criteria (see jsonfile_get)
+    :return: the list of selected embers
     """
-    with open(filename, "r") as file:
-        jsondata = json.load(file)
-
     # Filtering based on the inclusion_level is done first, because embers removed here can't be re-introduced
     # even by explicitly required them trough providing their id in 'emberids' below (same rule as in the API).
     # Note: bug fix on 17 July 2024 = add default inclusion level = 0, as done in the API (this was missing for files)
     ilev = int(kwargs["inclusion"]) if "inclusion" in kwargs else 0
-    jsondata["embers"] = [be for be in jsondata["embers"] if int(be["inclusion_level"]) >= ilev]
+    embers = [be for be in jsondata["embers"] if int(be["inclusion_level"]) >= ilev]
 
     # If ember ids were provided, get the list of corresponding embers;
     # Unlike the other filter criteria, emberids *add* embers to the retained set => temporarily stored in 'bes'
     if "emberids" in kwargs:
         filt = kwargs["emberids"].split('-')
-        bes = [be for be in jsondata["embers"] if str(be["id"]) in filt]
+        bes = [be for be in embers if str(be["id"]) in filt]
     else:
         bes = None  # list of embers to add after filtering.
 
     # Filter the received embers according to the other criteria (each criteria reduces the selected set)
     filtered = False
     if "longname" in kwargs:
-        filt = kwargs["longname"]
-        jsondata["embers"] = [be for be in jsondata["embers"] if stringmatch(filt, be["longname"])]
+        query = compile_criteria(kwargs["longname"])
+        embers = [be for be in embers if query.match(normtext(be["longname"]))]
         filtered = True
 
     if "source" in kwargs:
-        filt = kwargs["source"]
+        query = compile_criteria(kwargs["source"])
         figs = jsondata["figures"]
         bibrefs = jsondata["biblioreferences"]
-        bibids = [bib["id"] for bib in bibrefs if stringmatch(filt, bib["cite_key"])]
+        bibids = [bib["id"] for bib in bibrefs if query.match(normtext(bib["cite_key"]))]
         # Follow relations
         # (done for consistency with remote API; in practice starting from the crossref might not be needed
         #  because the search function 'stringmatch' would find the parent reference in the cite-key)
         bibids = [bib["id"] for bib in bibrefs if bib["crossref_id"] in bibids or bib["id"] in bibids]
         figids = [fig["id"] for fig in figs if fig["biblioreference_id"] in bibids]
-        if stringmatch(filt, ""):
+        if query.match(normtext("")):
             figids.append(None)
-        jsondata["embers"] = [be for be in jsondata["embers"] if be["mainfigure_id"] in figids]
+        embers = [be for be in embers if be["mainfigure_id"] in figids]
         filtered = True
 
     if "keywords" in kwargs:
-        filt = kwargs["keywords"]
-        jsondata["embers"] = [be for be in jsondata["embers"] if stringmatch(filt, be["keywords"])]
+        query = compile_criteria(kwargs["keywords"])
+        embers = [be for be in embers if query.match(normtext(be["keywords"]))]
         filtered = True
 
     if "scenario" in kwargs:
-        filt = kwargs["scenario"]
+        query = compile_criteria(kwargs["scenario"])
         scens = jsondata["scenarios"]
-        scids = [scen["id"] for scen in scens if stringmatch(filt, scen["name"])]
-        if stringmatch(filt, ""):
+        scids = [scen["id"] for scen in scens if query.match(normtext(scen["name"]))]
+        if query.match(normtext("")):
             scids.append(None)
-        jsondata["embers"] = [be for be in jsondata["embers"] if be["scenario_id"] in scids]
+        embers = [be for be in embers if be["scenario_id"] in scids]
         filtered = True
 
     # Assemble the outputs from the two filterings (see above: emberids results add to the other filtered results)
     if bes:
         if filtered:
-            jsondata["embers"] = [be for be in bes if be not in jsondata["embers"]] + jsondata["embers"]
+            embers = [be for be in bes if be not in embers] + embers
         else:
-            jsondata["embers"] = bes
+            embers = bes
+    return embers
+
+
+def jsonfile_get(filename, **kwargs):
+    """
+    Returns the filtered content of a json file according to the combination of criteria defined in dset
+    Search/filter expressions may contain the boolean operators AND/OR/NOT, but cannot use &/|/!.
+
+    The file is only parsed on the first call (or when it changes): the data is then taken from an in-memory store,
+    and embers are selected through an index of the archive when possible (see archive.py).
+    With ARCHIVE_STREAMING, the file is instead read on each call, keeping only the selected embers
+    (see json_stream.py).
+    The file may also be a binary archive (directory), from which only the selected embers are read
+    (see edb_archive.py).
+
+    :param filename: Full name of the json input file
+    :keyword: Search/filter criteria (see Embers_retreive_API.md).
+                     In this software, it is usually provided as part of the 'data set parameters' (dset).
+    :return: A dict of ember-related data, containing embers and other data read from the input file.
+             The dicts describing each ember, figure, etc. are shared with the store: they should not be modified.
+    """
+    if ARCHIVE_STREAMING and not path.isdir(filename):
+        jsondata = read_archive(filename, **kwargs)
+        jsondata["embers"] = filter_embers(jsondata, **kwargs)
+    else:
+        store = get_store(filename)
+        jsondata = store.view()
+        index = store.index()
+        if index:
+            jsondata["embers"] = store.records(index.select(**kwargs))
+        else:
+            jsondata["embers"] = store.records(filter_embers(jsondata, **kwargs))
 
     if jsondata["meta"]:
         jsondata["meta"]["embers_count"] = len(jsondata["embers"])
@@ -255,7 +437,7 @@ def getdata(dset, as_embers=True, desc=False):
                  as defined in settings_configs.py
     :param as_embers: if True, converts the data to ember objects
     :param desc: if True, includes the description of embers and transitions
-    :return: a dict containing data.
+    :return: a dict containing data; the same data is then taken from a cache, as a new copy (see query_cache.py)
     """
     report.write("Embers selection:", title=2)
     for crit in ['emberids', 'source', 'keywords', 'scenario', 'longname']:
@@ -263,21 +445,41 @@ def getdata(dset, as_embers=True, desc=False):
             report.write(f"{crit.capitalize()}: {dset[crit]}")
             logging.debug(f"{crit.capitalize()}: {dset[crit]}")
 
-    request_param_str.first = True
-    if API_URL:
-        request = (f"{API_URL}/api/combined_data"
-                   + request_param_str(dset, 'emberids')
-                   + request_param_str(dset, 'source')
-                   + request_param_str(dset, 'keywords')
-                   + request_param_str(dset, 'scenario')
-                   + request_param_str(dset, 'longname')
-                   + request_param_str(dset, 'inclusion')
-                   + (request_param_str({"desc": ""}, 'desc') if desc else ""))
-
-        response = requests.get(request, headers={"Authorization": f"Token {TOKEN}"})
+    if API_URL and API_BULK:
+        # All data is downloaded once, then filtered locally as for an archive file
+        archive = bulk_archive(API_URL, TOKEN, desc=desc)
+    elif API_URL:
+        archive = None
+    else:
+        archive = FILE
+    key = query_key(dset, source_stamp(archive) if archive else api_request(dset, desc=desc), as_embers, desc)
+    shared = {'egr': risk_graph()} if as_embers else None
+    cached = query_cache.get(key, shared)
+    if cached:
+        data, lines = cached
+        for txt, title, level in lines:
+            report.write(txt, title=title, level=level)
+        return data
+
+    report.recorded = []
+    try:
+        data = _getdata(dset, archive, as_embers, desc)
+    finally:
+        lines, report.recorded = report.recorded, None
+    query_cache.put(key, data, lines, shared)
+    return data
+
+
+def _getdata(dset, archive, as_embers, desc):
+    """
+    Gets data from the archive file, or from the API if archive is None (see getdata)
+    """
+    if archive:
+        request = f"Read from {'bulk download' if API_URL else 'file'}, {dset}"
+        response = jsonfile_get(archive, **dset)
     else:
-        request = f"Read from file, {dset}"
-        response = jsonfile_get(FILE, **dset)
+        request = api_request(dset, desc=desc)
+        response = get_client(TOKEN).get(request)
 
     if response.ok:
         report.write(f"Data received from: {API_URL if API_URL else FILE}")
@@ -302,14 +504,46 @@ def getdata(dset, as_embers=True, desc=False):
         conv_gmt = dset["conv_gmt"] if "conv_gmt" in dset else "compulsory"
         try:
             # Extract ember data and convert to Ember objects from Embermaker
-            return extractdata(response.content, conv_gmt=conv_gmt)
+            # (the cache of converted embers covers the whole archive: it is not used when streaming the archive)
+            return extractdata(response.content, conv_gmt=conv_gmt, archive=None if ARCHIVE_STREAMING else archive)
         except LookupError:
             raise LookupError(f"No data for {dset}")
     else:
         return json.loads(response.content) if type(response.content) is not dict else response.content
 
 
-def extractdata(jsondata, conv_gmt: str = 'compulsory'):
+def convert_ember(be):
+    """
+    Converts the hazard variable of an ember to GMT
+    :return: (whether the conversion succeeded, list of conversion log messages)
+    """
+    from embermaker.helpers import Logger
+    logger = Logger()
+    be.egr = risk_graph()  # Gives ember access to the risk level indexes, for interpolation etc.
+    try:
+        be.convert_haz('GMT', logger=logger)
+    except LookupError:
+        return False, []
+    return True, logger.getlog(0)
+
+
+def convert_record(jsbe: dict) -> tuple:
+    """
+    Converts the hazard variable of an ember provided as json data (a dict from the archive) to GMT
+    :return: (converted json data, whether the conversion succeeded, list of conversion log messages)
+    """
+    from embermaker.readembers import embers_from_json
+    be = embers_from_json([jsbe])[0]
+    success, log = convert_ember(be)
+    if not log:  # Not converted (already GMT, or conversion failed): the data is unchanged
+        return jsbe, success, log
+    transitions = [dict(jstr, levels={lv['phase']: lv['hazl'] for lv in trans.levels})
+                   for jstr, trans in zip(jsbe['transitions'], be.trans)]
+    return dict(jsbe, haz_valid=be.haz_valid, haz_name_std=be.haz_name_std, haz_name=be.haz_name,
+                transitions=transitions), success, log
+
+
+def extractdata(jsondata, conv_gmt: str = 'compulsory', archive: str = None):
     """
     Processes the burning embers received from the database API to get 'EmberMaker' drawable embers, +a link to figures
     :param jsondata: json data as string or byte string, or an equivalent dict containing the data to process.
@@ -317,8 +551,13 @@ def extractdata(jsondata, conv_gmt: str = 'compulsory'):
                     must be in ['compulsory', 'if_possible', 'never']
                     WARNING: if 'compulsory' is not used, this function may return inconsistent data, such as
                     a mix of sea-level rise in meters rise and warming in °C.
-    :return:
+    :param archive: the archive file from which jsondata was selected, if any: the embers converted to GMT are then
+                    taken from a persistent cache (see embers_cache.py)
+    :return: a dict containing the list of embers (Ember objects) and the lists of figures, scenarios and
+             biblioreferences, as well as these data indexed by id (e.g. 'figures_by_id') and the joins from figure ids
+             to their biblioreference ('figure_bibref') and to its citation key ('figure_cite_key').
     """
+    from embermaker.readembers import embers_from_json
     if conv_gmt not in ['compulsory', 'if_possible', 'never']:
         raise ValueError(f"conv_gmt must be 'compulsory', 'if_possible' or 'never', not {conv_gmt}")
 
@@ -338,37 +577,57 @@ def extractdata(jsondata, conv_gmt: str = 'compulsory'):
     report.write(f"Data extraction date: {data['meta']['extraction_date']}")
 
     # Convert the json ember data to Ember objects
-    lbes = embers_from_json(data['embers'])
-    logging.info(f"ExtractData: Received {len(lbes)} ember(s).")
-
-    logger = Logger()
-
-    # Convert hazard metric to GMT if possible, otherwise remove the ember
     if 'never' in conv_gmt.lower():
+        lbes = embers_from_json(data['embers'])
+        logging.info(f"ExtractData: Received {len(lbes)} ember(s).")
         report.write(f"WARNING: conversion to a common variable or unit is not active; inconsistencies may occur.")
     else:
-        for be in lbes.copy():
-            be.egr = egr  # Gives ember access to the risk level indexes, for interpolation etc.
-            try:
-                be.convert_haz('GMT', logger=logger)
-            except LookupError:
+        # Convert hazard metric to GMT if possible, otherwise remove the ember
+        # (the cache requires unique ember ids, which is checked when indexing the archive)
+        if archive and get_store(archive).index():
+            cached = converted_embers(get_store(archive), conv_gmt, convert_record)
+        else:
+            cached = {}
+        if cached and all(jsbe['id'] in cached for jsbe in data['embers']):
+            # Embers already converted: only the outcome of the conversion needs to be reported
+            conversions = [cached[jsbe['id']] for jsbe in data['embers']]
+            lbes = embers_from_json([jsbe for jsbe, success, log in conversions])
+            for be in lbes:
+                be.egr = risk_graph()
+            conversions = [(success, log) for jsbe, success, log in conversions]
+        else:
+            lbes = embers_from_json(data['embers'])
+            conversions = [convert_ember(be) for be in lbes]
+        logging.info(f"ExtractData: Received {len(lbes)} ember(s).")
+
+        conv_log = []
+        for be, (success, log) in zip(lbes.copy(), conversions):
+            conv_log += log
+            if not success:
                 if 'compulsory' in conv_gmt.lower():
                     lbes.remove(be)
-                    report.write(f"Removed ember '{be}' because hazard variable is {be.haz_name_std}")
+                    report.write(f"Removed ember '{be}' because hazard variable is {be.haz_name_std}", level=DETAIL)
                 else:
                     report.write(f"Ember '{be}' has the hazard variable {be.haz_name_std}, "
-                                 f"which could not be converted to GMT.")
+                                 f"which could not be converted to GMT.", level=DETAIL)
 
-        conv_log = logger.getlog(0)
         if conv_log:
-            report.write(f"Variable conversion log:\n {'<br> '.join(conv_log)}")
+            report.write(lambda: f"Variable conversion log:\n {'<br> '.join(conv_log)}", level=DETAIL)
     logging.info(f"ExtractData: Retained {len(lbes)} ember(s) after conversion to GMT.")
     if len(lbes) == 0:
         raise LookupError("ExtractData: no ember matches the provided criteria")
 
     figures = data['figures']
+    figures_by_id = index_by_id(figures)
+    bibrefs_by_id = index_by_id(data['biblioreferences'])
     return {'embers': lbes, 'figures': figures, 'scenarios': data['scenarios'],
-            'biblioreferences': data['biblioreferences']}
+            'biblioreferences': data['biblioreferences'],
+            'figures_by_id': figures_by_id,
+            'scenarios_by_id': index_by_id(data['scenarios']),
+            'biblioreferences_by_id': bibrefs_by_id,
+            'figure_bibref': {figid: bibrefs_by_id.get(fig['biblioreference_id'])
+                              for figid, fig in figures_by_id.items()},
+            'figure_cite_key': {figid: fig['biblioreference_cite_key'] for figid, fig in figures_by_id.items()}}
 
 
 def embers_col_background(xlim: tuple[float, float] = None, ylim: tuple[float, float] = None, dir='vertic',
@@ -383,6 +642,8 @@ def embers_col_background(xlim: tuple[float, float] = None, ylim: tuple[float, f
                        (there is no upper bound: increasing values result in less colour and more white)
     :return:
     """
+    import matplotlib.pyplot as plt
+    from matplotlib import colors
     if xlim is None:
         logging.critical("xlim is required")
         return
@@ -427,14 +688,26 @@ class Emberdata:
         return self.data['embers']
 
 
+def index_by_id(dicts) -> dict:
+    """
+    Indexes a list of dicts by their 'id', for direct access (see the '*_by_id' data provided by extractdata)
+    :param dicts: a list of dict objects, each having an 'id'
+    :return: a dict {id: dict}
+    """
+    return {dt['id']: dt for dt in dicts}
+
+
 def dict_by_id(dicts, id=None):
     """
     Gets a dict from a list of dicts such that dict['id'] = id.
-    :param dicts: a list of dict objects
+    Kept for compatibility: this scans the list, the '*_by_id' mappings from extractdata (or index_by_id) are faster.
+    :param dicts: a list of dict objects, or a dict of them indexed by id
     :param id: the required id
     :return: the corresponding dict
     """
     if id:
+        if isinstance(dicts, dict):
+            return dicts[id]
         return [dt for dt in dicts if dt['id'] == id][0]
     else:
         return None
@@ -450,47 +723,54 @@ def rfn(be, hazl, conf=False):
     :param conf: whether to return the confidence level
     :return: risk
     """
-
     try:
-        risk = np.interp(hazl, be.levels_values('hazl'), be.levels_values('risk'))
+        arrays = EmberArrays([be])
+        risk = arrays.risk_matrix([hazl], pointwise=True)[0, 0]
     except ValueError:
         raise ValueError(f"Risk could not be interpolated for the given hazard level (rfn) '{be.name}'; "
-                         f"n levels: {len(be.levels_values('hazl'))}")
+                         f"n levels: {len(be.levels())}")
 
     if not conf:
         return risk
+    return risk, int(arrays.confidence_matrix([hazl])[0, 0])  # Between 0 and 6, min
 
-    lvs = be.levels()
-    idx1 = bisect_right([lv['hazl'] for lv in lvs], hazl)
-    idx1 = min(idx1, len(lvs) - 1)
-    idx0 = max(idx1 - 1, 0)
-    if lvs[idx0] == hazl:
-        idx1 = idx0
-    try:
-        cf0 = lvs[idx0].trans.confidence[0]
-        cf1 = lvs[idx1].trans.confidence[0]
-        clevs = ['L', 'LM', 'M', 'MH', 'H', 'HVH', 'VH']
-        cid0 = clevs.index(cf0)
-        cid1 = clevs.index(cf1)
-        cid = min(cid0, cid1)
-    except IndexError:
-        cid = -1
-    return risk, cid  # Between 0 and 6, min
+
+def rfn_batch(lbes, hazls, conf=False):
+    """
+    Risk of each ember at each of the given hazard levels (same as rfn for each ember and hazard level)
+    :param lbes: a list of embers
+    :param hazls: a list of hazard levels
+    :param conf: whether to return the confidence levels
+    :return: risk, as a 2-D array (embers x hazard levels); if conf, (risk, confidence levels), where the confidence
+             levels are a 2-D array of integers between 0 and 6 (index in ember_arrays.CONFIDENCE_LEVELS), -1 if unknown
+    """
+    arrays = EmberArrays(lbes)
+    risk = arrays.risk_matrix(hazls, pointwise=True)
+    return (risk, arrays.confidence_matrix(hazls)) if conf else risk
 
 
 def hfn(be, rlev):
     """Returns the hazard level for a given risk level"""
-    return np.interp(rlev, be.levels_values('risk'), be.levels_values('hazl'))
+    return EmberArrays([be]).hazard_matrix([rlev], pointwise=True)[0, 0]
     # Note: there was a version of this function with right= 3.2 for testing.
 
 
+def hfn_batch(lbes, rlevs):
+    """
+    Hazard level of each ember for each of the given risk levels (same as hfn for each ember and risk level)
+    :return: 2-D array (embers x risk levels)
+    """
+    return EmberArrays(lbes).hazard_matrix(rlevs, pointwise=True)
+
+
 def rem_incomplete(lbes, mxhaz):
     newlbes = []
     for be in lbes:
-        if max(np.max(be.levels_values('hazl')), be.haz_valid[1]) < mxhaz:
+        haz_top = levels_view(be).haz_top
+        if haz_top < mxhaz:
             logging.warning(
                 f"Removed ember {be} / no assessment for GMT > "
-                f"{max(np.max(be.levels_values('hazl')), be.haz_valid[1])}")
+                f"{haz_top}")
         else:
             newlbes.append(be)
     logging.warning(f"#remaining embers: {len(lbes)}")
@@ -551,71 +831,23 @@ def get_skey_longname(regions: list):
     return skey
 
 
-class Report:
+def report_start(settings) -> Report:
     """
-    Helps in generating processing reports in Markdown format
+    Creates the processing report of a figure, in the 'reports' directory of its out_file, and makes it the current
+    report (helpers.report); it may also be used as a context manager, closing the report at the end.
     """
-    def __init__(self, filename):
-        self.nembers = 0
-        if filename:
-            filename = path.splitext(filename)[0] + '.md'
-            self.file = open(filename, 'w')
-        else:
-            self.file = None
-
-    def write(self, txt: str, title: int = 0):
-        """
-        :param txt: the text to write
-        :param title: the level of title / subtitle
-        """
-        if title == 1:
-            print(txt)
-        if title and title < 5:
-            prefix = "#" * title + " "
-        else:
-            prefix = ""
-        if self.file:
-            self.file.write(f"\n{prefix}{txt}\n")
-
-    def table_head(self, *headers):
-        if self.file:
-            self.file.write(f'\n| {" | ".join(headers)}\n')
-            self.file.write(f'| {" --- | " * len(headers)}\n')
-
-    def table_write(self, *content):
-        if self.file:
-            self.file.write(f'| {" | ".join([str(c) for c in content])}\n')
-
-    def embers_list(self, lbes, onlyids=False):
-        self.nembers += len(lbes)
-        if onlyids:
-            self.write(f'Ember ids (n={len(lbes)}):', title=3)
-            self.write(', '.join([str(be.id) for be in lbes]))
-        else:
-            self.write(f'Ember names and ids (n={len(lbes)}):', title=3)
-            self.write('<br>'.join([be.longname + " (" + str(be.id) + ")" for be in lbes]))
-
-    def close(self, total=True):
-        if total:
-            self.write(f'Total number of embers listed in this report: {self.nembers}', title=3)
-        if self.file:
-            self.file.close()
-
-
-def report_start(settings):
-    global report
     dir, file = path.split(settings['out_file'])
     repfile = path.join(dir, 'reports', file)
     repdir = path.split(repfile)[0]
-    if not path.exists(repdir):
-        makedirs(repdir)
-    report = Report(repfile)
+    makedirs(repdir, exist_ok=True)
+    new_report = open_report(repfile).activate()
     title = settings['title'].replace('\n', ' ')
-    report.write(f"{title}", title=1)
+    new_report.write(f"{title}", title=1)
+    return new_report
 
 
-# We use only one "global" report, which is easy to refer to, by importing helpers
-report = Report(None)
+# The report of the current figure (see report.py), which is easy to refer to, by importing helpers
+report = CurrentReport()
 
 
 # AR6 RKR categories
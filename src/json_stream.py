@@ -0,0 +1,171 @@
+"""
+Streaming reader and writer for json archive files, for archives too large to be kept in memory
+(by default, the archive is parsed once and kept in memory, see archive.py).
+The reader parses the file incrementally, one ember at a time, and only keeps the embers which may match the search
+criteria, with the (small) other tables: the memory used does not grow with the number of embers in the archive.
+Setting (in settings_data_access, optional): ARCHIVE_STREAMING (default False).
+"""
+import re
+import json
+from os import replace, getpid
+import settings_data_access
+from src.archive import ARCHIVE_TABLES
+from src.textsearch import compile_criteria, normtext
+
+ARCHIVE_STREAMING = getattr(settings_data_access, 'ARCHIVE_STREAMING', False)
+CHUNK_SIZE = 1 << 20  # Characters read from the file at once
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStream:
+    """
+    Incremental json parser: reads a text file by chunks, and decodes it one value at a time
+    """
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size=None) -> bool:
+        """
+        Appends the next chunk of the file to the buffer, dropping the part already parsed
+        :return: False at the end of the file
+        """
+        chunk = self.file.read(size or self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skips white space and returns the next character ('' at the end of the file)
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        """
+        Decodes the next json value
+        """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                error = None
+            except json.JSONDecodeError as err:
+                end, error = None, err
+            # The value may continue in the next chunk (also for a number at the end of the buffer):
+            # read more, doubling the size so that large values are not decoded too many times
+            if end is None or end == len(self.buffer):
+                if self._read(size):
+                    size *= 2
+                    continue
+                if error:
+                    raise error
+            self.pos = end
+            return value
+
+    def array(self):
+        """
+        Iterates over the elements of the next value, which must be a json array
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+
+def prefilter(**kwargs):
+    """
+    Returns a function telling whether an ember may be selected with the given search criteria, using only the fields
+    of the ember itself (inclusion level, ids, longname and keywords). Applying helpers.filter_embers to the retained
+    embers then gives the same result as applying it to all embers, because the other criteria only reduce the selection
+    and the embers selected by their ids are always retained.
+    :keyword: Search/filter criteria (see helpers.jsonfile_get)
+    """
+    ilev = int(kwargs["inclusion"]) if "inclusion" in kwargs else 0
+    ids = set(kwargs["emberids"].split('-')) if "emberids" in kwargs else set()
+    queries = [(field, compile_criteria(kwargs[field])) for field in ("longname", "keywords") if field in kwargs]
+
+    def keep(be) -> bool:
+        if int(be["inclusion_level"]) < ilev:
+            return False
+        return str(be["id"]) in ids or all(query.match(normtext(be[field])) for field, query in queries)
+
+    return keep
+
+
+def read_archive(filename, **kwargs) -> dict:
+    """
+    Reads an archive file, keeping only the embers which may match the search criteria (see prefilter)
+    :param filename: the archive file
+    :keyword: Search/filter criteria (see helpers.jsonfile_get)
+    :return: a dict with the tables and 'meta', as ArchiveStore.view()
+    """
+    keep = prefilter(**kwargs)
+    jsondata = {}
+    with open(filename, encoding='utf-8-sig') as file:
+        stream = JsonStream(file)
+        try:
+            stream.expect('{')
+            if stream.peek() == '}':
+                stream.pos += 1
+            else:
+                while True:
+                    key = stream.value()
+                    stream.expect(':')
+                    if key in ARCHIVE_TABLES and stream.peek() == '[':
+                        if key == 'embers':
+                            jsondata[key] = [be for be in stream.array() if keep(be)]
+                        else:
+                            jsondata[key] = list(stream.array())
+                    else:
+                        jsondata[key] = stream.value()
+                    if stream.peek() == ',':
+                        stream.pos += 1
+                    else:
+                        stream.expect('}')
+                        break
+            if stream.peek():
+                raise json.JSONDecodeError("Extra data", stream.buffer, stream.pos)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"Could not read the archive file '{filename}': {err}")
+    for key in ARCHIVE_TABLES:
+        if type(jsondata.get(key)) is not list:
+            raise ValueError(f"Invalid archive file '{filename}': '{key}' should be a list")
+    data = {key: jsondata[key] for key in ARCHIVE_TABLES}
+    data['meta'] = jsondata.get('meta')
+    return data
+
+
+def write_json(filename, data, indent=4):
+    """
+    Writes data to a json file as it is encoded, without building the whole json text in memory;
+    the result is the same as with json.dumps(data, indent=indent, ensure_ascii=False).
+    """
+    tmpname = f"{filename}.{getpid()}.tmp"
+    with open(tmpname, "w", encoding='utf8') as outfile:
+        for chunk in json.JSONEncoder(indent=indent, ensure_ascii=False).iterencode(data):
+            outfile.write(chunk)
+    replace(tmpname, filename)
@@ -0,0 +1,134 @@
+"""
+Build manifest for make_figures: records, for each output (settings 'out_file'), a hash of the inputs of the figure
+and the hashes of the files it produced, so that a figure can be skipped when nothing it depends on has changed.
+The inputs are: the data (hash of the archive file), the resolved settings (including the options and title),
+the settings of the processing reports (REPORT_FORMAT and REPORT_VERBOSITY, see report.py),
+the version of this code (src.__version__ and a hash of the source files) and the version of EmberMaker.
+Remote data is identified by the hash of the bulk download (API_BULK, see remote.py); without API_BULK, it cannot be
+identified without downloading each data subset, so figures based on remote data are always rebuilt.
+"""
+import json
+import hashlib
+import glob
+from functools import lru_cache
+from datetime import datetime
+from os import path, replace
+from importlib.metadata import version, PackageNotFoundError
+import settings_configs
+import src
+from src.archive import get_store
+from src.query_cache import source_stamp
+from src.remote import bulk_archive, API_BULK
+from src.json_stream import ARCHIVE_STREAMING
+from src.report import REPORT_FORMAT, REPORT_VERBOSITY
+from settings_data_access import API_URL, TOKEN, FILE
+
+MANIFEST = "manifest.json"
+
+
+def file_hash(filename) -> str:
+    sha = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def code_version() -> str:
+    """
+    Version of the code used to build figures: version numbers and hash of the source files in src
+    """
+    sha = hashlib.sha256(src.__version__.encode())
+    try:
+        sha.update(version('embermaker').encode())
+    except PackageNotFoundError:
+        pass
+    for filename in sorted(glob.glob(path.join(path.dirname(src.__file__), "*.py"))):
+        sha.update(path.basename(filename).encode())
+        sha.update(file_hash(filename).encode())
+    return sha.hexdigest()
+
+
+@lru_cache(maxsize=4)
+def _streamed_hash(stamp) -> str:
+    # Same as the hash of the store, without keeping the archive in memory; computed once per version of the file
+    return file_hash(stamp[0])
+
+
+def data_version():
+    """
+    Identifies the data: hash of the archive file (or of the bulk download), or None for other remote data
+    """
+    if API_URL and not API_BULK:
+        return None
+    filename = bulk_archive(API_URL, TOKEN) if API_URL else FILE
+    if ARCHIVE_STREAMING and not path.isdir(filename):
+        return _streamed_hash(source_stamp(filename))
+    store = get_store(filename)
+    store.base()  # Makes sure that the hash is up-to-date
+    return store.hash
+
+
+def outputs(out_file) -> list:
+    """
+    Files produced for the given output: those starting with out_file, and their processing report(s)
+    """
+    outdir, basename = path.split(out_file)
+    return sorted(glob.glob(glob.escape(out_file) + "*")
+                  + glob.glob(path.join(glob.escape(outdir), "reports", glob.escape(basename) + "*")))
+
+
+class Manifest:
+    """
+    The manifest for the figures built within a directory (stored as manifest.json in that directory)
+    """
+    def __init__(self, out_path):
+        self.filename = path.join(path.dirname(out_path) if path.basename(out_path) else out_path, MANIFEST)
+        try:
+            with open(self.filename) as file:
+                self.entries = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    @staticmethod
+    def inputs(dtype, kwargs) -> tuple:
+        """
+        :param dtype: the name of the function building a figure (e.g. 'mean_percentiles')
+        :param kwargs: its arguments, as for get_settings
+        :return: (out_file, hash of the inputs or None if the inputs cannot be identified)
+        """
+        settings = settings_configs.get_settings(dtype=dtype, **kwargs)
+        dversion = data_version()
+        if dversion is None:
+            return settings['out_file'], None
+        content = json.dumps({'data': dversion, 'settings': settings, 'code': code_version(),
+                              'report': {'format': REPORT_FORMAT, 'verbosity': REPORT_VERBOSITY}},
+                             sort_keys=True, default=str)
+        return settings['out_file'], hashlib.sha256(content.encode()).hexdigest()
+
+    def is_current(self, out_file, inputs) -> bool:
+        """
+        Whether the output is up-to-date: same inputs as for the last build, and files not changed since then
+        """
+        entry = self.entries.get(out_file)
+        if not inputs or not entry or entry['inputs'] != inputs or not entry['outputs']:
+            return False
+        return all(path.exists(fname) and file_hash(fname) == fhash for fname, fhash in entry['outputs'].items())
+
+    def record(self, out_file, inputs):
+        """
+        Records the inputs and the produced files after a successful build
+        """
+        if inputs:
+            self.entries[out_file] = {'inputs': inputs,
+                                      'outputs': {fname: file_hash(fname) for fname in outputs(out_file)},
+                                      'built': datetime.now().isoformat(timespec='seconds')}
+        else:
+            self.entries.pop(out_file, None)
+
+    def save(self):
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as file:
+            json.dump(self.entries, file, indent=1, sort_keys=True)
+        replace(tmpname, self.filename)
@@ -5,9 +5,13 @@ import settings_configs
 from embermaker.embergraph import EmberGraph
 from embermaker import ember as emb
 from itertools import groupby
+from src.ember_arrays import EmberArrays, column_groups, compress_columns
+from src.bootstrap import bootstrap, draw_transitions
+from src.report import DETAIL
 
 
-def mean_percentiles(**kwargs):
+@settings_configs.diagram_type
+def mean_percentiles(*args, **kwargs):
     """
     Cumulative distribution of mid-points within transitions.
     Arguments are passed to get_settings:
@@ -15,9 +19,11 @@ def mean_percentiles(**kwargs):
     - a list of options, added to the settings
     """
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    settings = settings_configs.get_settings(**kwargs)
+    settings = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     hlp.report_start(settings)
+    # Get the data for all data subsets at once, rather than waiting for each request in the loop below
+    hlp.prefetch([settings])
     # Create plot
     fig, ax = plt.subplots()
 
@@ -46,7 +52,7 @@ def mean_percentiles(**kwargs):
             lbes = hlp.rem_incomplete(lbes, hazlevs[-1])
 
         if 'wchapter' in dset['options']:  # Optional 'per chapter' weighting: this will provide the chapter + fig n°
-            figures = data['figures']  # A list of embers providing information on the main figure containing them
+            figures = data['figures_by_id']  # Information on the main figure containing each ember, by figure id
         else:
             figures = None
             # if no weighting, report the list of embers (with weighing, this will be done when weights ar calculated)
@@ -77,6 +83,14 @@ def mean_percentiles(**kwargs):
             ax.plot(hazlevs, risk_p10, color=dset['style'][0], linestyle="--")
             ax.plot(hazlevs, risk_p90, color=dset['style'][0], linestyle="--")
 
+        # Optional confidence intervals from bootstrap resampling
+        if 'bootstrap' in dset['options']:
+            bands = bootstrap(lbes, hazlevs, dset, emberbase)
+            for curve in ('mean', 'median'):
+                if curve in dset['options']:
+                    ax.fill_between(hazlevs, *bands[curve], color=dset['style'][0], alpha=0.15, linewidth=0)
+            draw_transitions(ax, bands, dset['style'][0])
+
         ax.grid(axis='x', color='0.65')
 
         # 'Aggregated ember'
@@ -123,7 +137,7 @@ def mean_percentiles(**kwargs):
     # Finalise the x-y percentile and/or median plots
     plt.rcParams['svg.fonttype'] = 'none'
     fig.savefig(f"{settings['out_file']}.pdf", format="pdf")
-    plt.show()
+    hlp.show_figure(fig)
     hlp.report.close()
 
 
@@ -135,89 +149,62 @@ def aggreg(lbes, hazlevs: np.array, ax=None, dset=None, exprisk=False, figures=N
     :param ax: matplotlib axes - if provided, adds n=, the number of embers for which risk is defined at a given T
     :param dset: settings for the current data subset
     :param exprisk: whether to use an exponential risk index (2**<received index>)
-    :param figures: figure list containing data about each figure, for weighting; None => each ember has a weight of 1
+    :param figures: dict of figures by id, containing data about each figure, for weighting;
+                    None => each ember has a weight of 1
     :return: p10, median, p90, average
     """
-    risk_tots = np.zeros(len(hazlevs))
-    risk_avgs = np.zeros(len(hazlevs))
-    risk_p10 = np.zeros(len(hazlevs))
-    risk_p50 = np.zeros(len(hazlevs))
-    risk_p90 = np.zeros(len(hazlevs))
-
-    rmean_std = []
-    nemb = 0
-
-    if figures:
-        hlp.report.write(f"Weighting per chapter/figure (n total={len(lbes)})", title=2)
-        hlp.report.table_head("Weighting group", "Embers", "Weight")
-        # Calculate weights: 'equal weight per chapter/figure' option
-        # (weighting per chapter is the rule, per figure is applied to SRCCL and SR1.5, due to differences in scope)
-        # Create a dict that will link the id of each ember (the key) to the label of its weighting group:
-        be_groups = dict()
-        for be in lbes:
-            # Get information about the main figure containing ember be:
-            figinfo: dict = hlp.dict_by_id(figures, be.meta['mainfigure_id'])
-            # Generate and set the group label for each ember
-            if figinfo['biblioreference_cite_key'] in ('SRCCL', 'SR1.5'):  # Exception: split by figure
-                be_groups[be.id] = figinfo['biblioreference_cite_key'] + '-' + str(figinfo['number'])
-            else:
-                be_groups[be.id] = figinfo['biblioreference_cite_key']
-
-        groups_list = list(be_groups.values())
-        for group_key, be_set in groupby(lbes, lambda xbe: be_groups[xbe.id]):
-            weight = 1.0 / groups_list.count(group_key)
-            names = ""
-            for be in be_set:
-                be.ext['weight'] = weight
-                names += f"{be.longname}({be.id});<br>"
-            hlp.report.table_write(group_key, names, f"{weight:5.2f}")
-    else:
-        for be in lbes:
-            be.ext['weight'] = 1.0
+    weights = hlp.set_weights(lbes, figures)
 
     # Calculate mean and percentiles among all embers, for each hazard level (x axis values)
-    extend = []
-    exclude = []
+    hazlevs = np.asarray(hazlevs)
+    ebs = EmberArrays(lbes)
+    risk = ebs.risk_matrix(hazlevs)  # Risk index of each ember (rows) at each hazard level (columns)
+    # Include the data only if we have indications that it was assessed up to that 'hazard' level:
+    #   - haz_valid[1] indicates that it is valid above the current level, or
+    #   - a transition was assessed above the current level (= accepted even if above haz_valid[1])
+    # With or without weighting (weight=1), 'removing' embers does not change the weight of other embers
+    #   (figures share the same haz_valid[1]: in most cases, all embers of a group are removed together).
+    included = ebs.haz_top[:, None] >= hazlevs[None, :]
+    counts = included.sum(axis=0)
+    contribs = (2**risk if exprisk else risk) * weights[:, None]
+    risk_tots = np.where(included, contribs, 0.0).sum(axis=0)
+
+    # Statistics of the included embers: columns having the same number of included embers are processed together
+    sum_weights = np.zeros(len(hazlevs))
+    rmean_std = np.full(len(hazlevs), np.nan)
+    for columns, nincl in column_groups(included):
+        if nincl:
+            rmean_std[columns] = np.std(compress_columns(risk, included, columns, nincl), axis=1) / np.sqrt(len(lbes))
+            sum_weights[columns] = np.sum(compress_columns(np.broadcast_to(weights[:, None], risk.shape),
+                                                           included, columns, nincl), axis=1)
+    # Percentiles are not affected by using an exp scale or not => no need to calculate using exp:
+    risk_p10, risk_p50, risk_p90 = hlp.weighted_percentile_columns(risk, (10.0, 50.0, 90.0), weights, mask=included)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        risk_avgs = np.log2(risk_tots / sum_weights) if exprisk else risk_tots / sum_weights
+
+    # Hazard levels at which each ember gets an extended validity or stops being included, for the report
+    events = {}
+    if hlp.report.enabled(DETAIL):
+        extended = included & (hazlevs[None, :] > ebs.haz_valid_top[:, None])
+        for ibe, be in enumerate(lbes):
+            if extended[ibe].any():
+                events.setdefault(int(np.argmax(extended[ibe])), []).append((ibe, True))
+            if not included[ibe].all():
+                events.setdefault(int(np.argmin(included[ibe])), []).append((ibe, False))
+
+    nemb = 0
     for lev, hazl in enumerate(hazlevs):
-        # For each hazard level, lists of ember-related data will be generated for the 'included' embers (see below)
-        risk_hazl = []
-        weights = []
-        names = []
-        for be in lbes:
-            # Include the data only if we have indications that it was assessed up to that 'hazard' level:
-            #   - haz_valid[1] indicates that it is valid above the current level, or
-            #   - a transition was assessed above the current level (= accepted even if above haz_valid[1])
-            # With or without weighting (weight=1), 'removing' embers does not change the weight of other embers
-            #   (figures share the same haz_valid[1]: in most cases, all embers of a group are removed together).
-            trmax = np.max(be.levels_values('hazl'))
-            # Process included embers
-            if max(trmax, be.haz_valid[1]) >= hazl:
-                if hazl > be.haz_valid[1] and be.id not in extend:
-                    hlp.report.write(f"Extended validity for ember '{be.longname}': {be.haz_valid[1]} -> {trmax}")
-                    extend.append(be.id)
-                intrisk = hlp.rfn(be, hazl)
-                if exprisk:
-                    risk_tots[lev] += 2**intrisk * be.ext['weight']
-                else:
-                    risk_tots[lev] += intrisk * be.ext['weight']
-                # Percentiles are not affected by using an exp scale or not => no need to calculate using exp:
-                risk_hazl.append(intrisk)
-                weights.append(be.ext['weight'])
-                names.append(be.longname)
-            # Record information about embers no longer included as this hazard level:
-            elif be.id not in exclude:
-                hlp.report.write(
-                    f"Ignoring {be.longname} for hazard >= {hazl:.2f} (trmax: {trmax}, haz_valid[1]: {be.haz_valid[1]})"
-                )
-                exclude.append(be.id)
-
-        rmean_std.append(np.std(risk_hazl)/np.sqrt(len(lbes)))
-
-        risk_p10[lev], risk_p50[lev], risk_p90[lev] = (
-            hlp.weighted_percentile(risk_hazl, (10.0, 50.0, 90.0), weights=weights))
+        for ibe, extend in sorted(events.get(lev, [])):
+            be = lbes[ibe]
+            if extend:
+                hlp.report.write(f"Extended validity for ember '{be.longname}': {be.haz_valid[1]} -> {ebs.trmax[ibe]}",
+                                 level=DETAIL)
+            else:
+                hlp.report.write(f"Ignoring {be.longname} for hazard >= {hazl:.2f} "
+                                 f"(trmax: {ebs.trmax[ibe]}, haz_valid[1]: {be.haz_valid[1]})", level=DETAIL)
 
         if abs(hazl-3.0) < 0.02:  # At 3°C, report information about what is within p10 and p90.
-            names_risk = list(zip(names, risk_hazl))
+            names_risk = [(be.longname, risk[ibe, lev]) for ibe, be in enumerate(lbes) if included[ibe, lev]]
             names_risk.sort(key=lambda nr: nr[1])
             hlp.report.write(f"Information about percentiles at 3°C", title=2)
             hlp.report.write(f"Risk level at p10:{risk_p10[lev]:4.1f};"
@@ -225,13 +212,8 @@ def aggreg(lbes, hazlevs: np.array, ax=None, dset=None, exprisk=False, figures=N
             report_percentile(10, risk_p10[lev], names_risk)
             report_percentile(90, risk_p90[lev], names_risk)
 
-        if exprisk:
-            risk_avgs[lev] = np.log2(risk_tots[lev] / np.sum(weights))
-        else:
-            risk_avgs[lev] = risk_tots[lev] / np.sum(weights)
-
-        if nemb != len(risk_hazl):
-            nemb = len(risk_hazl)
+        if nemb != counts[lev]:
+            nemb = counts[lev]
             # Show n= when the number of embers changes
             # This should move to a drawing function if the code is used again.
             if ax:
@@ -2,22 +2,26 @@
 Usage : python overview.py <settings name in settings_configs.py>
 """
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import src.helpers as hlp
 import settings_configs
 import logging
 from itertools import groupby
 
 
-def overview(**kwargs):
+@settings_configs.diagram_type
+def overview(*args, **kwargs):
     """
     Arguments are passed to get_settings:
     - settings_choice: the name of the desired settings within settings_config.py
     - a list of options, added to the settings
     """
     # Get settings from edb_paper_settings, according to the choices made in keyword arguments (see getsettings)
-    settings = settings_configs.get_settings(**kwargs)
+    settings = settings_configs.get_settings(*args, **kwargs)
     # Create global report file (Markdown)
     hlp.report_start(settings)
+    # Get the data for all data subsets at once, rather than waiting for each request in the loop below
+    hlp.prefetch([settings])
 
     # Create plot
     fig = plt.figure(figsize=(4, 8))
@@ -35,7 +39,7 @@ def overview(**kwargs):
         # Get data for the current subset (dset)
         data = hlp.getdata(dset)
         lbes = data['embers']  # The list of burning embers in this data subset
-        scenarios = data['scenarios']
+        scenarios = data['scenarios_by_id']
         hlp.report.embers_list(lbes, onlyids=True)
 
         # Sort and group embers
@@ -44,7 +48,7 @@ def overview(**kwargs):
         lbes.sort(key=lambda abe: abe.name)
 
         # If there is a scenario (= adaptation related, so far), sort by scenario
-        lbes.sort(key=lambda abe: hlp.dict_by_id(scenarios, id=abe.meta['scenario_id'])['adapt_index']
+        lbes.sort(key=lambda abe: scenarios[abe.meta['scenario_id']]['adapt_index']
                   if abe.meta['scenario_id'] else -1)
         # Regroup embers in the same scenario group (= adaptation variants)
         lbes.sort(key=lambda abe: abe.meta['scenariogroup_id'] if abe.meta['scenariogroup_id'] else -1)
@@ -79,7 +83,7 @@ def overview(**kwargs):
 
     plt.rcParams['svg.fonttype'] = 'none'
     fig.savefig(f"{settings['out_file']}.pdf", format="pdf")
-    plt.show()
+    hlp.show_figure(fig)
     hlp.report.close()
 
 
@@ -92,8 +96,8 @@ def riskchart(lbes, dset=None, ax=None, istart=0, data=None):
         return 0
 
     curcolor = dset['color']
-    scenarios = data['scenarios']
-    figures = data['figures']
+    scenarios = data['scenarios_by_id']
+    cite_keys = data['figure_cite_key']
     pi0 = -1
     pi1 = -1
     pi2 = -1
@@ -121,28 +125,32 @@ def riskchart(lbes, dset=None, ax=None, istart=0, data=None):
 
     hlp.report.write(f"Large risk change wrt. GMT ({dset['GMT'][0]}->{dset['GMT'][2]}°C) for:")
     seplineleft = -0.45
-    plt.hlines(istart + len(lbes) + 0.5, seplineleft, 3.1, color="#AAA", linewidths=0.3, clip_on=False)
+    # Separators, connectors and markers are collected in the loop below, then drawn at once (one artist for each)
+    seplines = [istart + len(lbes) + 0.5]
+    connectors = []
+    connectors_widths = []
+    markers = [(6, [], []), (3.7, [], []), (2, [], [])]  # For GMT[2], [1], [0]: (marker size, positions, colours)
+    # Risk and confidence of all embers at the 3 GMT levels
+    risks, confs = hlp.rfn_batch(lbes, dset['GMT'][:3], conf=True)
     for ibe, be in enumerate(lbes):
 
-        i0, c0 = hlp.rfn(be, dset['GMT'][0], conf=True)
-        i1, c1 = hlp.rfn(be, dset['GMT'][1], conf=True)
-        i2, c2 = hlp.rfn(be, dset['GMT'][2], conf=True)
+        i0, i1, i2 = risks[ibe]
+        c0, c1, c2 = confs[ibe]
         ebpos = istart + len(lbes) - ibe
 
         if (i2 - i0) > 1.25:
             hlp.report.write(f"* {be.longname} - risk level change: {i0:5.2f}->{i2:5.2f} ")
         gid = be.meta['scenariogroup_id']
-        plt.hlines(ebpos-0.5, seplineleft, 3.1, color="#AAA", linewidths=0.3, clip_on=False)
+        seplines.append(ebpos - 0.5)
         name = ""
-        citekey = hlp.dict_by_id(figures, be.meta['mainfigure_id'])['biblioreference_cite_key']
+        citekey = cite_keys[be.meta['mainfigure_id']]
         convcite = {'AR6': 'A6', 'SR1': '1.5', 'SRO': 'O', 'SRC': 'L'}
         name_sfx = f'[{convcite[citekey[0:3]]}]' if 'hide_chapter' not in dset else ''
         if gid is None:
             name = be.longname
         elif pgid == gid:
-            ax.plot((pi0, i0), (ppos, ebpos), color='#0006', zorder=3, linewidth=0.2, solid_capstyle='round')
-            ax.plot((pi1, i1), (ppos, ebpos), color='#0006', zorder=3, linewidth=0.45, solid_capstyle='round')
-            ax.plot((pi2, i2), (ppos, ebpos), color='#0006', zorder=3, linewidth=0.9, solid_capstyle='round')
+            connectors += [((pi0, ppos), (i0, ebpos)), ((pi1, ppos), (i1, ebpos)), ((pi2, ppos), (i2, ebpos))]
+            connectors_widths += [0.2, 0.45, 0.9]
         else:
             name = be.group
 
@@ -158,20 +166,16 @@ def riskchart(lbes, dset=None, ax=None, istart=0, data=None):
 
         if be.meta['scenario_id']:
             sc_id = be.meta['scenario_id']
-            adapt_index = hlp.dict_by_id(scenarios, sc_id)['adapt_index']
+            adapt_index = scenarios[sc_id]['adapt_index']
             adapt = ['■', '■□', '■■', '■■□', '■■■'][int(adapt_index*2)-2]
             plt.rcParams['font.family'] = 'DejaVu Sans'
             ax.text(-0.42, ebpos, f"{adapt}", fontsize=4, color='#AAAAAA', verticalalignment='center',
                     horizontalalignment='left', zorder=2)
 
-        # if i3 >= 0:
-        #    ax.plot(i3, ebpos, 's', color=scolor, markeredgewidth=0.2, markeredgecolor="white", markersize=4)
-        if i2 >= 0:
-            ax.plot(i2, ebpos, 'o', color=colconf(c2), markeredgewidth=0.3, markeredgecolor="white", markersize=6)
-        if i1 >= 0:
-            ax.plot(i1, ebpos, 'o', color=colconf(c1), markeredgewidth=0.3, markeredgecolor="white", markersize=3.7)
-        if i0 >= 0:
-            ax.plot(i0, ebpos, 'o', color=colconf(c0), markeredgewidth=0.3, markeredgecolor="white", markersize=2)
+        for (size, positions, colours), risk, conf in zip(markers, (i2, i1, i0), (c2, c1, c0)):
+            if risk >= 0:
+                positions.append((risk, ebpos))
+                colours.append(colconf(conf))
         if name:
             plt.rcParams['font.family'] = 'Avenir Next Condensed'
             ax.text(-0.5, ebpos + 0.3, f"{name}", fontsize=4, color=curcolor,
@@ -182,6 +186,14 @@ def riskchart(lbes, dset=None, ax=None, istart=0, data=None):
         ppos = ebpos
         pgid = gid
 
+    ax.hlines(seplines, seplineleft, 3.1, color="#AAA", linewidths=0.3, clip_on=False)
+    if connectors:
+        ax.add_collection(LineCollection(connectors, colors='#0006', linewidths=connectors_widths, capstyle='round',
+                                         zorder=3))
+    # Markers in decreasing size, so that the smaller ones are visible (same zorder as markers from ax.plot)
+    for size, positions, colours in markers:
+        if positions:
+            ax.scatter(*zip(*positions), s=size ** 2, c=colours, linewidths=0.3, edgecolors='white', zorder=2)
     ax.vlines(-0.1, 0.5, istart + len(lbes) + 0.5, color="#AAA", linewidth=0.3, clip_on=False)
     ax.set_yticks([])
     ax.set_xticks([0, 1, 2, 3], labels=['Undetectable', 'Moderate', 'High', 'Very\nhigh'], fontsize=6)
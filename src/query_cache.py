@@ -0,0 +1,128 @@
+"""
+In-memory cache of the data returned by helpers.getdata, shared by the figures built in the same process
+(e.g. several figures of make_figures use the same settings_choice, hence the same data subsets).
+Entries are identified by the selection criteria, the processing options and the data source (see query_key);
+they are stored as pickled bytes, so that each request gets its own copy of the embers, which callers may modify
+(e.g. be.ext['weight'] in mean_percentiles.aggreg). The lines written to the processing report while getting the data
+are stored with it, so that the reports remain the same when the data comes from the cache.
+The memory used is bounded by QUERY_CACHE_MB (from settings_data_access; default 256; 0 = no cache):
+the least recently used entries are removed first.
+"""
+import io
+import pickle
+import threading
+from collections import OrderedDict
+from os import path, stat
+import settings_data_access
+
+QUERY_CACHE_MB = getattr(settings_data_access, 'QUERY_CACHE_MB', 256)
+CRITERIA = ('emberids', 'source', 'keywords', 'scenario', 'longname', 'inclusion')
+
+
+def source_stamp(filename) -> tuple:
+    """
+    Identifies the current version of an archive file (or binary archive directory), as the archive stores do
+    """
+    if path.isdir(filename):
+        filename = path.join(filename, "meta.json")
+    st = stat(filename)
+    return filename, st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def query_key(dset, source, as_embers=True, desc=False) -> tuple:
+    """
+    :param dset: the settings of a data subset (see helpers.getdata)
+    :param source: identifies the data source, e.g. source_stamp(archive file) or the url of the API request
+    :param as_embers, desc: as for helpers.getdata
+    :return: the key of the data in the cache; the criteria are kept as they are written in the API request
+      (absent and empty criteria differ, see helpers.filter_embers)
+    """
+    criteria = tuple((crit, str(dset[crit])) for crit in CRITERIA if crit in dset)
+    return criteria, dset.get('conv_gmt', 'compulsory'), bool(as_embers), bool(desc), source
+
+
+class _Pickler(pickle.Pickler):
+    # Objects shared by all embers (such as the risk graph, be.egr) are not copied: they are stored as references
+    def __init__(self, file, shared):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = {id(obj): name for name, obj in shared.items()}
+
+    def persistent_id(self, obj):
+        return self.shared.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+
+    def persistent_load(self, pid):
+        return self.shared[pid]
+
+
+class QueryCache:
+    """
+    LRU cache of (data, report lines) by query key, bounded by the total size of the pickled data
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key: (pickled data, report lines)
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, shared=None):
+        """
+        :param key: the query key (see query_key)
+        :param shared: objects which were not copied when the data was stored (see put)
+        :return: (a new copy of the data, report lines), or None if the key is not in the cache
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        content, lines = entry
+        return _Unpickler(io.BytesIO(content), shared or {}).load(), lines
+
+    def put(self, key, data, lines=(), shared=None):
+        """
+        Stores a copy of the data; the data itself can then be modified by the caller.
+        :param key: the query key (see query_key)
+        :param data: the data, which must be picklable except for the shared objects
+        :param lines: the lines written to the processing report while getting the data, as (text, title) tuples
+        :param shared: {name: object} of the objects referred to by the data which are not copied
+        """
+        if self.max_bytes <= 0:
+            return
+        file = io.BytesIO()
+        _Pickler(file, shared or {}).dump(data)
+        content = file.getvalue()
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= len(self._entries.pop(key)[0])
+            self._entries[key] = (content, tuple(lines))
+            self.nbytes += len(content)
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= len(self._entries.popitem(last=False)[1][0])
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.nbytes}
+
+
+# The cache shared by all figures built in this process
+query_cache = QueryCache(int(QUERY_CACHE_MB * (1 << 20)))
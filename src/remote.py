@@ -0,0 +1,228 @@
+"""
+Client for the API of the embers database (remote or local server, see settings_data_access.py).
+All requests go through one HTTP session (connections are kept alive and reused), ask for compressed (gzip) responses,
+have a timeout, and are retried with exponential backoff when the connection fails or the server is temporarily
+unavailable. Responses are stored in a local cache with their ETag / Last-Modified headers: later requests for the same
+data are conditional, so that the data is only downloaded again if it changed; within a process, each request is only
+sent once. Several requests can be prefetched concurrently (ApiClient.prefetch), to be then taken from memory.
+With API_BULK, the complete data is downloaded once and stored in the format of the archive file (bulk_archive);
+data subsets are then selected locally, as for the archive file (see helpers.getdata and consistency.py).
+Settings (in settings_data_access, optional): API_TIMEOUT (seconds), API_RETRIES, API_CONCURRENCY, API_BULK,
+CACHE_DIR.
+"""
+import json
+import hashlib
+import asyncio
+import threading
+from os import path, makedirs, replace, getpid, register_at_fork
+from tempfile import gettempdir
+import settings_data_access
+from src.embers_cache import CACHE_DIR
+
+API_TIMEOUT = getattr(settings_data_access, 'API_TIMEOUT', 120)
+API_RETRIES = getattr(settings_data_access, 'API_RETRIES', 3)
+API_CONCURRENCY = getattr(settings_data_access, 'API_CONCURRENCY', 8)
+API_BULK = getattr(settings_data_access, 'API_BULK', False)
+
+
+class CachedResponse:
+    """
+    A response served from the local cache (has the attributes of requests.Response used in this code)
+    """
+    def __init__(self, content: bytes, url: str):
+        self.ok = True
+        self.status_code = 200
+        self.content = content
+        self.url = url
+
+
+class ApiClient:
+    def __init__(self, token, timeout=API_TIMEOUT, retries=API_RETRIES, cache_dir=CACHE_DIR):
+        """
+        :param token: the authentication token for the API
+        :param timeout: timeout for connecting and for receiving data, in seconds
+        :param retries: number of retries after a failed request
+        :param cache_dir: directory of the local cache (responses are stored in its 'api' subdirectory);
+                          None = no local cache
+        """
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_dir = path.join(cache_dir, 'api') if cache_dir else None
+        self.session = self._new_session()
+        self._received = {}  # Content received during this process, by url
+        self.validators = {}  # ETag / Last-Modified of the content received, by url (if provided by the server)
+        self._lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'not_modified': 0, 'reused': 0}
+
+    def _new_session(self):
+        # Imported here, as most runs do not use the API
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        session = requests.Session()
+        session.headers.update({"Authorization": f"Token {self.token}", "Accept-Encoding": "gzip, deflate"})
+        retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset({'GET'}), raise_on_status=False)
+        # The pool keeps one connection for each concurrent request (see prefetch)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(10, API_CONCURRENCY))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _cache_files(self, url):
+        # The token is part of the key, because the data available through the API may depend on the user
+        key = hashlib.sha256(f"{self.token}|{url}".encode()).hexdigest()
+        return path.join(self.cache_dir, key + ".json"), path.join(self.cache_dir, key + ".meta")
+
+    def _read_cache(self, url):
+        """
+        :return: (content, validators) from the local cache, or (None, None)
+        """
+        if not self.cache_dir:
+            return None, None
+        datafile, metafile = self._cache_files(url)
+        try:
+            with open(metafile) as file:
+                validators = json.load(file)
+            with open(datafile, "rb") as file:
+                return file.read(), validators
+        except (OSError, json.JSONDecodeError):
+            return None, None
+
+    def _write_cache(self, url, content: bytes, validators: dict):
+        makedirs(self.cache_dir, exist_ok=True)
+        for filename, data in zip(self._cache_files(url), (content, json.dumps(validators).encode())):
+            tmpname = f"{filename}.{getpid()}.tmp"
+            with open(tmpname, "wb") as file:
+                file.write(data)
+            replace(tmpname, filename)
+
+    def get(self, url):
+        """
+        Gets data from the API: from this process' memory if it was already received, otherwise with a conditional
+        request if the data is in the local cache, otherwise with a normal request.
+        :param url: the full url of the request
+        :return: a requests.Response, or a CachedResponse
+        """
+        if url in self._received:
+            self._count('reused')
+            return CachedResponse(self._received[url], url)
+
+        content, validators = self._read_cache(url)
+        headers = {}
+        if content is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and content is not None:
+            self._count('not_modified')
+            self._received[url] = content
+            self.validators[url] = validators
+            return CachedResponse(content, url)
+
+        if response.ok:
+            self._count('downloaded')
+            self._received[url] = response.content
+            validators = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified')}
+            if validators['etag'] or validators['last_modified']:
+                self.validators[url] = validators
+                if self.cache_dir:
+                    self._write_cache(url, response.content, validators)
+        return response
+
+    def prefetch(self, urls, concurrency=API_CONCURRENCY) -> dict:
+        """
+        Gets the data for several requests concurrently, so that it is then available from memory for get().
+        Duplicate urls are only requested once; failed requests are not kept, so that get() will report the error.
+        :param urls: the full urls of the requests
+        :param concurrency: maximum number of requests sent at the same time
+        :return: dict {url: status code, or None if the request failed without response}, for the requests sent
+        """
+        urls = [url for url in dict.fromkeys(urls) if url not in self._received]
+        if not urls:
+            return {}
+        return asyncio.run(self._prefetch(urls, concurrency))
+
+    async def _prefetch(self, urls, concurrency):
+        import requests
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(url):
+            async with semaphore:
+                try:
+                    response = await asyncio.to_thread(self.get, url)
+                except requests.RequestException:
+                    return url, None
+            return url, response.status_code
+
+        return dict(await asyncio.gather(*(fetch(url) for url in urls)))
+
+
+# Clients, by token (there is usually a single one)
+_clients = {}
+# Archive files of the bulk downloads made by this process, by (token, url)
+_bulk_archives = {}
+
+
+def get_client(token) -> ApiClient:
+    if token not in _clients:
+        _clients[token] = ApiClient(token)
+    return _clients[token]
+
+
+def _reset_sessions():
+    # A forked process (e.g. a worker building figures) keeps the data already received, but must not share
+    # the connections of its parent
+    for client in _clients.values():
+        client.session = client._new_session()
+
+
+register_at_fork(after_in_child=_reset_sessions)
+
+
+def bulk_archive(api_url, token, desc=False) -> str:
+    """
+    Downloads all embers (all inclusion levels) with the related data, and stores them as an archive file;
+    this is only done once per process, and the data is only downloaded (and the file written) if it changed
+    since the previous download, according to its ETag / Last-Modified (stored next to the file, as .meta).
+    :param api_url: base url of the API
+    :param token: the authentication token for the API
+    :param desc: whether to include the descriptions of embers and transitions
+    :return: the name of the archive file
+    """
+    url = f"{api_url}/api/combined_data?inclusion=-3" + ("&desc=" if desc else "")
+    if (token, url) in _bulk_archives:
+        return _bulk_archives[(token, url)]
+    client = get_client(token)
+    response = client.get(url)
+    if not response.ok:
+        raise ConnectionError(f"Bulk download '{url}' failed with status {response.status_code}")
+    key = hashlib.sha256(f"{token}|{url}".encode()).hexdigest()[:32]
+    filename = path.join(CACHE_DIR or gettempdir(), f"bulk_{key}.json")
+    metafile = path.join(CACHE_DIR or gettempdir(), f"bulk_{key}.meta")
+    validators = client.validators.get(url)
+    try:
+        with open(metafile) as file:
+            unchanged = validators is not None and json.load(file) == validators and path.exists(filename)
+    except (OSError, json.JSONDecodeError):
+        unchanged = False
+    if not unchanged:
+        makedirs(path.dirname(filename), exist_ok=True)
+        # The archive is written before its validators, so that they never describe another content
+        for fname, data in ((metafile, b"null"), (filename, response.content),
+                            (metafile, json.dumps(validators).encode())):
+            tmpname = f"{fname}.{getpid()}.tmp"
+            with open(tmpname, "wb") as file:
+                file.write(data)
+            replace(tmpname, fname)
+    _bulk_archives[(token, url)] = filename
+    return filename
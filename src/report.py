@@ -0,0 +1,222 @@
+"""
+Processing reports, provided with each figure (see helpers.report_start).
+The report of the current figure is found through a context variable (current_report), so that figures built
+concurrently, each within its own context, have their own report; helpers.report refers to it (CurrentReport).
+Messages are kept in memory and written to the sink in large blocks: a Markdown file, a JSON lines file, or nothing.
+Messages above the verbosity of the report are dropped without being formatted (when given as a function or when
+the caller checks Report.enabled).
+Settings (in settings_data_access, optional): REPORT_FORMAT ('markdown' (default), 'jsonl' or None = no report file)
+and REPORT_VERBOSITY (SUMMARY, INFO or DETAIL (default), see below; 0 = no messages).
+"""
+import json
+import threading
+from contextvars import ContextVar
+from os import path
+import settings_data_access
+
+# Verbosity levels: a message is kept if its level is not above the verbosity of the report
+SUMMARY = 1  # Titles
+INFO = 2  # Default for other messages
+DETAIL = 3  # Messages about individual embers in the processing loops
+
+REPORT_FORMAT = getattr(settings_data_access, 'REPORT_FORMAT', 'markdown')
+REPORT_VERBOSITY = getattr(settings_data_access, 'REPORT_VERBOSITY', DETAIL)
+BUFFER_SIZE = 1 << 16  # Characters kept in memory before being written to the sink
+
+
+class MarkdownSink:
+    extension = '.md'
+
+    def __init__(self, filename):
+        self.file = open(path.splitext(filename)[0] + self.extension, 'w')
+
+    @staticmethod
+    def format(kind, content, title=0) -> str:
+        if kind == 'text':
+            prefix = "#" * title + " " if title and title < 5 else ""
+            return f"\n{prefix}{content}\n"
+        if kind == 'table_head':
+            return f'\n| {" | ".join(content)}\n| {" --- | " * len(content)}\n'
+        return f'| {" | ".join(content)}\n'
+
+    def write(self, records):
+        self.file.write(''.join(self.format(*record) for record in records))
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesSink(MarkdownSink):
+    """
+    One json object per message: {"type": "text", "text": ..., "title": ...} or {"type": "table_head"|"table_row",
+    "cells": [...]}
+    """
+    extension = '.jsonl'
+
+    @staticmethod
+    def format(kind, content, title=0) -> str:
+        record = {'type': kind, 'text': content, 'title': title} if kind == 'text' else {'type': kind, 'cells': content}
+        return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+class NullSink:
+    """
+    Drops all messages (e.g. for benchmarks)
+    """
+    def write(self, records):
+        pass
+
+    def close(self):
+        pass
+
+
+SINKS = {'markdown': MarkdownSink, 'jsonl': JsonLinesSink, None: lambda filename: NullSink()}
+
+
+class Report:
+    """
+    Helps in generating processing reports; can be used as a context manager, which makes it the current report
+    and closes it at the end.
+    """
+    def __init__(self, sink=None, verbosity=REPORT_VERBOSITY):
+        """
+        :param sink: where the messages are written (MarkdownSink, JsonLinesSink, NullSink, or None: nowhere)
+        :param verbosity: messages with a higher level are dropped
+        """
+        self.sink = sink
+        self.verbosity = verbosity
+        self.nembers = 0
+        self.recorded = None  # When set to a list, the written lines are also added to it, as (text, title, level)
+        self._buffer = []
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._token = None
+
+    def enabled(self, level=INFO) -> bool:
+        """
+        Whether messages of the given level are kept: callers may skip preparing them otherwise
+        """
+        return level <= self.verbosity
+
+    def _add(self, record, size):
+        if self.sink is None:
+            return
+        with self._lock:
+            self._buffer.append(record)
+            self._buffered += size
+            if self._buffered > BUFFER_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self.sink.write(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+
+    def flush(self):
+        with self._lock:
+            if self.sink is not None:
+                self._flush()
+
+    def write(self, txt, title: int = 0, level: int = None):
+        """
+        :param txt: the text to write, or a function returning it (only called if the message is kept)
+        :param title: the level of title / subtitle
+        :param level: the verbosity level of the message; default: SUMMARY for titles, INFO otherwise
+        """
+        level = level or (SUMMARY if title else INFO)
+        if level > self.verbosity:
+            return
+        if callable(txt):
+            txt = txt()
+        if self.recorded is not None:
+            self.recorded.append((txt, title, level))
+        if title == 1:
+            print(txt)
+        self._add(('text', txt, title), len(txt))
+
+    def table_head(self, *headers, level: int = INFO):
+        if level <= self.verbosity:
+            self._add(('table_head', [str(h) for h in headers]), 8 * len(headers))
+
+    def table_write(self, *content, level: int = INFO):
+        if level <= self.verbosity:
+            cells = [str(c) for c in content]
+            self._add(('table_row', cells), sum(len(c) for c in cells))
+
+    def embers_list(self, lbes, onlyids=False):
+        self.nembers += len(lbes)
+        if onlyids:
+            self.write(f'Ember ids (n={len(lbes)}):', title=3)
+            self.write(lambda: ', '.join([str(be.id) for be in lbes]))
+        else:
+            self.write(f'Ember names and ids (n={len(lbes)}):', title=3)
+            self.write(lambda: '<br>'.join([be.longname + " (" + str(be.id) + ")" for be in lbes]))
+
+    def close(self, total=True):
+        """
+        Writes the remaining messages and closes the sink; the report then ignores messages (except for printing titles)
+        """
+        if total:
+            self.write(f'Total number of embers listed in this report: {self.nembers}', title=3)
+        with self._lock:
+            if self.sink is not None:
+                self._flush()
+                self.sink.close()
+                self.sink = None
+
+    def activate(self):
+        """
+        Makes this report the current report (in the current context)
+        """
+        if current_report() is not self:
+            self._token = _current.set(self)
+        return self
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, *exc):
+        self.close()
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+
+
+def open_report(filename, fmt=REPORT_FORMAT, verbosity=REPORT_VERBOSITY) -> Report:
+    """
+    :param filename: the name of the report file, without extension (the extension depends on the format)
+    :param fmt: the format of the report file (see SINKS)
+    :param verbosity: see Report
+    :return: the new report (not activated)
+    """
+    if fmt not in SINKS:
+        raise ValueError(f"Unknown report format '{fmt}'; available formats: {', '.join(map(str, SINKS))}")
+    return Report(SINKS[fmt](filename), verbosity)
+
+
+def open_document(filename) -> Report:
+    """
+    A Markdown document (e.g. a table) written with the interface of Report: all messages are kept
+    """
+    return Report(MarkdownSink(filename), verbosity=DETAIL)
+
+
+# Report used when no report was started in the current context (messages are only printed, for titles)
+_default = Report(None)
+_current = ContextVar('report', default=_default)
+
+
+def current_report() -> Report:
+    return _current.get()
+
+
+class CurrentReport:
+    """
+    Refers to the current report, whatever it is when it is used (see helpers.report)
+    """
+    def __getattr__(self, name):
+        return getattr(_current.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(_current.get(), name, value)
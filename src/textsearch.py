@@ -0,0 +1,202 @@
+"""
+Text search with boolean criteria, as used to filter embers (see helpers.stringmatch).
+Criteria are parsed once into a query tree (memoised by criteria string), and each searched text is normalised once,
+so that filtering many embers only requires one walk of the query tree for each ember.
+Queries can also be evaluated on an inverted index of the texts (TextIndex), as operations on sets of ids.
+"""
+import re
+from functools import lru_cache
+
+# Character 'translation' tool to replace all white spaces with standard spaces
+_BLANKS = str.maketrans("\t\n\r\x0b\x0c\xa0", "      ")
+# Regex to insert blanks as word boundaries
+_WORDBOUNDS = re.compile(r'([.,;-])')
+# Regex to split the criteria into a list of tuples: [(<string to find>,<operator>), ...]
+_CRITERIA = re.compile(r"(|\b[^']*?\b|\'.*?\') *(\(|\)|\bAND\b|\bOR\b|\bNOT\b|$)")
+
+
+class NormText:
+    """
+    A text prepared for searching: lower case, with blanks around word boundaries and without plural forms
+    (= 's' removed when at end of a word), padded with spaces; the set of words it contains is also provided.
+    """
+    __slots__ = ('padded', 'words')
+
+    def __init__(self, text: str):
+        ptext = " " + _WORDBOUNDS.sub(r' \1 ', text).translate(_BLANKS).lower() + " "
+        self.padded = ptext.replace("s ", " ")
+        self.words = frozenset(self.padded.split(' '))
+
+
+@lru_cache(maxsize=16384)
+def normtext(text: str) -> NormText:
+    """
+    Returns the normalised version of text (cached, because the same ember fields are searched by many queries)
+    """
+    return NormText(text)
+
+
+class TextIndex:
+    """
+    Inverted index of the words found in a set of texts (e.g. the longnames of all embers), giving the ids of the texts;
+    the texts are normalised as for NormText, so that select() on the index gives the same results as match().
+    """
+    def __init__(self, items):
+        """
+        :param items: iterable of (id, text) pairs
+        """
+        self.texts = {}
+        words = {}
+        for tid, text in items:
+            ntext = normtext(text)
+            self.texts[tid] = ntext
+            for word in ntext.words:
+                words.setdefault(word, set()).add(tid)
+        self.words = {word: frozenset(tids) for word, tids in words.items()}
+        self.universe = frozenset(self.texts)
+
+
+class Term:
+    """A fragment of text to look for (a word, or a sequence of words such as 'ecosystem services')"""
+    def __init__(self, fragment: str):
+        # Apply to the search fragment the same processing as for the searched text:
+        self.pattern = _WORDBOUNDS.sub(r' \1 ', f" {fragment} ").replace("s ", " ")
+        word = self.pattern[1:-1]
+        # A single word can be looked up in the set of words, which is faster than searching the padded text
+        self.word = word if word and ' ' not in word else None
+
+    def match(self, ntext: NormText) -> bool:
+        if self.word:
+            return self.word in ntext.words
+        return self.pattern in ntext.padded
+
+    def select(self, index: TextIndex) -> frozenset:
+        if self.word:
+            return index.words.get(self.word, frozenset())
+        # Sequence of words: candidates are the texts containing all the words, then check the sequence itself
+        words = [word for word in self.pattern.split(' ') if word]
+        candidates = index.universe
+        for word in words:
+            candidates = candidates & index.words.get(word, frozenset())
+        return frozenset(tid for tid in candidates if self.pattern in index.texts[tid].padded)
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def match(self, ntext: NormText) -> bool:
+        return not self.operand.match(ntext)
+
+    def select(self, index: TextIndex) -> frozenset:
+        return index.universe - self.operand.select(index)
+
+
+class And:
+    def __init__(self, operands: list):
+        self.operands = operands
+
+    def match(self, ntext: NormText) -> bool:
+        return all(op.match(ntext) for op in self.operands)
+
+    def select(self, index: TextIndex) -> frozenset:
+        return frozenset.intersection(*(op.select(index) for op in self.operands))
+
+
+class Or:
+    def __init__(self, operands: list):
+        self.operands = operands
+
+    def match(self, ntext: NormText) -> bool:
+        return any(op.match(ntext) for op in self.operands)
+
+    def select(self, index: TextIndex) -> frozenset:
+        return frozenset.union(*(op.select(index) for op in self.operands))
+
+
+class MatchAll:
+    """Query for empty criteria: everything matches"""
+    def match(self, ntext: NormText) -> bool:
+        return True
+
+    def select(self, index: TextIndex) -> frozenset:
+        return index.universe
+
+
+class _Parser:
+    """
+    Recursive descent parser for the criteria, with the usual precedence of boolean operators (NOT > AND > OR):
+        expr := conj ('or' conj)* ;  conj := neg ('and' neg)* ;  neg := 'not' neg | Term | '(' expr ')'
+    """
+    def __init__(self, criteria: str):
+        self.criteria = criteria
+        self.tokens = []
+        for fragment, operator in _CRITERIA.findall(criteria):
+            tx = fragment.lower().translate(_BLANKS).strip().strip("'")
+            if tx:
+                self.tokens.append(Term(tx))
+            if operator:
+                self.tokens.append(operator.lower())
+        self.pos = 0
+
+    def error(self):
+        return ValueError(f"Stringmatch could not parse the criteria '{self.criteria}'")
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise self.error()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        query = self.expr()
+        if self.pos != len(self.tokens):
+            raise self.error()
+        return query
+
+    def expr(self):
+        operands = [self.conj()]
+        while self.peek() == 'or':
+            self.take()
+            operands.append(self.conj())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def conj(self):
+        operands = [self.neg()]
+        while self.peek() == 'and':
+            self.take()
+            operands.append(self.neg())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def neg(self):
+        token = self.take()
+        if token == 'not':
+            return Not(self.neg())
+        if token == '(':
+            query = self.expr()
+            if self.take() != ')':
+                raise self.error()
+            return query
+        if isinstance(token, Term):
+            return token
+        raise self.error()
+
+
+@lru_cache(maxsize=1024)
+def compile_criteria(criteria: str):
+    """
+    Parses search criteria such as "ecosystems AND NOT ('ecosystem services' OR fishing)" into a query tree.
+    The result is memoised: the same criteria are typically applied to every ember in a data set.
+    :param criteria: the search criteria (see helpers.stringmatch)
+    :return: a query object, whose method match(normtext(text)) tells whether a text matches the criteria,
+             and select(index) returns the ids of the matching texts within a TextIndex
+    """
+    if not criteria:
+        return MatchAll()
+    if '!' in criteria or '&' in criteria or '|' in criteria:
+        raise Exception('Stringmatch: &,|,! are not allowed; please use the AND/OR/NOT syntax for boolean operators')
+    return _Parser(criteria).parse()
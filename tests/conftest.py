@@ -0,0 +1,5 @@
+# The tests import the modules of the repository as make_figures.py does (import src.helpers, import settings_configs)
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,39 @@
+"""
+Importing make_figures and src.helpers must not import the heavy dependencies, which are only imported by the
+functions that need them (figures, tables, API requests); this keeps the command line (e.g. --list) and the
+worker processes fast to start.
+"""
+import json
+import subprocess
+import sys
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+HEAVY = ('matplotlib', 'pandas', 'requests', 'embermaker')
+# Import time, in seconds, in a new interpreter: about 0.2 s here (numpy included), vs 1.2 s with the heavy
+# dependencies; the margin allows for slower machines
+BUDGET = 0.6
+
+SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import make_figures
+import src.helpers
+duration = time.perf_counter() - start
+print(json.dumps({{'duration': duration, 'imported': [name for name in {HEAVY!r} if name in sys.modules]}}))
+"""
+
+
+def run_import():
+    result = subprocess.run([sys.executable, "-c", SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_heavy_dependencies_not_imported():
+    assert run_import()['imported'] == []
+
+
+def test_import_time():
+    # The best of several runs, so that a busy machine does not make the test fail
+    duration = min(run_import()['duration'] for _ in range(3))
+    assert duration < BUDGET, f"Importing make_figures and src.helpers took {duration:.2f} s (budget: {BUDGET} s)"
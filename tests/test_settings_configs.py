@@ -0,0 +1,29 @@
+"""
+The functions producing diagrams get their settings with positional or keyword arguments (see diagram_type),
+and get_settings still accepts calls without dtype, from functions which are not decorated.
+"""
+import pytest
+import settings_configs
+
+ARGS = ("overview_systems", ["wchapter"], "Overview")
+
+
+@settings_configs.diagram_type
+def overview(*args, **kwargs):
+    return settings_configs.get_settings(*args, **kwargs)
+
+
+def test_positional_and_keyword_arguments():
+    expected = settings_configs.get_settings(*ARGS, dtype="overview")
+    assert overview(*ARGS) == expected
+    assert overview(settings_choice=ARGS[0], options=ARGS[1], title=ARGS[2]) == expected
+    assert expected['type'] == "overview"
+
+
+def test_missing_dtype():
+    def undecorated():
+        return settings_configs.get_settings(*ARGS)
+
+    with pytest.warns(DeprecationWarning, match="without dtype"):
+        settings = undecorated()
+    assert settings == settings_configs.get_settings(*ARGS, dtype="undecorated")
@@ -0,0 +1,126 @@
+"""
+weighted_percentile_columns must give, bit for bit, the same results as weighted_percentile applied to each column,
+as mean_percentiles.aggreg did before using it.
+"""
+from os import path
+import numpy as np
+import pytest
+import src.helpers as hlp
+
+PERCENTILES = (10.0, 50.0, 90.0)
+
+
+def per_column(values, p, weights, mask):
+    """
+    The previous implementation in aggreg: weighted_percentile on the valid values of each column
+    """
+    result = np.full((len(p), values.shape[1]), np.nan)
+    for col in range(values.shape[1]):
+        if mask[:, col].any():
+            result[:, col] = hlp.weighted_percentile(values[mask[:, col], col], p, weights=weights[mask[:, col]])
+    return result
+
+
+def check(values, weights, mask):
+    expected = per_column(values, PERCENTILES, weights, mask)
+    result = hlp.weighted_percentile_columns(values, PERCENTILES, weights, mask=mask)
+    assert result.shape == expected.shape
+    assert np.array_equal(result, expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random(seed):
+    rng = np.random.default_rng(seed)
+    nsamples, ncols = rng.integers(1, 40), rng.integers(1, 30)
+    values = rng.uniform(0, 3, (nsamples, ncols))
+    weights = rng.uniform(0.1, 2, nsamples)
+    mask = rng.random((nsamples, ncols)) < 0.8
+    check(values, weights, mask)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_ties(seed):
+    # Risk levels are often equal (e.g. 0 below the first transition, 3 above the last one)
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 4, (25, 12)) / 2.0
+    weights = rng.choice([0.25, 0.5, 1.0], 25)
+    mask = rng.random(values.shape) < 0.9
+    check(values, weights, mask)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_equal_weights(seed):
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(0, 3, (17, 8))
+    mask = np.ones(values.shape, dtype=bool)
+    check(values, np.ones(17), mask)
+    # Default weights and mask
+    assert np.array_equal(hlp.weighted_percentile_columns(values, PERCENTILES),
+                          per_column(values, PERCENTILES, np.ones(17), mask))
+
+
+def test_nan_masked():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(0, 3, (20, 10))
+    mask = rng.random(values.shape) < 0.7
+    values[~mask] = np.nan  # Masked values are ignored, whatever they are
+    mask[:, 3] = False  # Column without valid values: nan
+    weights = rng.uniform(0.5, 1.5, 20)
+    check(values, weights, mask)
+    assert np.isnan(hlp.weighted_percentile_columns(values, PERCENTILES, weights, mask=mask)[:, 3]).all()
+
+
+def test_scalar_percentile():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(0, 3, (9, 5))
+    weights = rng.uniform(0.5, 1.5, 9)
+    mask = np.ones(values.shape, dtype=bool)
+    result = hlp.weighted_percentile_columns(values, 50.0, weights, mask=mask)
+    assert np.array_equal(result, per_column(values, (50.0,), weights, mask)[0])
+
+
+def test_aggreg(monkeypatch):
+    """
+    The percentiles returned by aggreg for the embers of an archive are those of the previous per-column loop
+    """
+    import settings_data_access
+    from src.mean_percentiles import aggreg
+    if not getattr(settings_data_access, 'FILE', None) or not path.exists(settings_data_access.FILE):
+        pytest.skip("requires an archive file (FILE in settings_data_access.py)")
+    dset = {'source': "AR6-WGII", 'inclusion': 0}
+    lbes = hlp.getdata(dset)['embers']
+    hazlevs = np.arange(0.0, 4.5, 0.01)
+
+    calls = []
+    batched = hlp.weighted_percentile_columns
+
+    def spy(values, p, weights=None, mask=None):
+        calls.append((np.array(values), p, np.array(weights), np.array(mask)))
+        return batched(values, p, weights, mask=mask)
+
+    monkeypatch.setattr(hlp, 'weighted_percentile_columns', spy)
+    data = hlp.getdata(dset)
+    figures = data['figures']
+    for weighted in (False, True):
+        calls.clear()
+        risk_p10, risk_p50, risk_p90, risk_avgs = aggreg(lbes, hazlevs, dset=dset,
+                                                         figures=data['figures_by_id'] if weighted else None)
+        (risk, p, weights, included), = calls
+        expected_weights = group_weights(lbes, figures) if weighted else np.ones(len(lbes))
+        assert np.array_equal(weights, expected_weights)
+        expected = per_column(risk, p, expected_weights, included)
+        assert np.array_equal(np.array([risk_p10, risk_p50, risk_p90]), expected, equal_nan=True)
+    assert len(set(expected_weights)) > 1  # The weighted case is not trivial
+
+
+def group_weights(lbes, figures):
+    """
+    The weights of the 'wchapter' option: 1 / number of embers in the group of each ember (its chapter, or its figure
+    for SRCCL and SR1.5), found from the list of figures of the archive
+    """
+    groups = []
+    for be in lbes:
+        fig, = [fig for fig in figures if fig['id'] == be.meta['mainfigure_id']]
+        key = fig['biblioreference_cite_key']
+        groups.append(f"{key}-{fig['number']}" if key in ('SRCCL', 'SR1.5') else key)
+    return np.array([1.0 / groups.count(group) for group in groups])